@@ -0,0 +1,107 @@
+""" Commands per second in broker mode (worker processes) vs threads """
+import argparse
+import asyncio
+import json
+import logging
+import threading
+import time
+
+from stirbot import IRCServer
+from fakeserver import FakeServer
+
+
+def work(chan, nick, host, match, bot=None):
+    """ CPU bound command: holds the GIL for a while, then replies """
+    total = 0
+    for i in range(int(match.group(2))):
+        total += i * i
+    bot.sendMessage(chan, 'done %s' % match.group(1))
+
+
+def setup(bot):
+    """ Adds the command to a bot or a broker worker """
+    bot.addCommand(
+            'work', r'^!work (\d+) (\d+)',
+            lambda chan, nick, host, match: work(chan, nick, host, match, bot)
+            )
+
+
+def run(workers, commands, channels, loops, threads):
+    bot = IRCServer(
+            'bot', '127.0.0.1', autojoin=[], threads=threads,
+            floodrate=10**6, floodburst=10**6, queuesize=commands
+            )
+    if workers:
+        # forked before any thread is started
+        bot.startBroker(workers, setup, threads=threads, queuesize=commands)
+    else:
+        setup(bot)
+    replies, done = {}, threading.Event()
+    state = {'start': None, 'count': 0}
+
+    def onLine(server, client, line):
+        words = line.split(' ')
+        if words[0] == 'PRIVMSG' and words[2] == ':done':
+            replies.setdefault(words[1], []).append(int(words[3]))
+            state['count'] += 1
+            if state['count'] == commands:
+                done.set()
+
+    async def onClient(server, client):
+        # no head start: the workers may still be connecting
+        state['start'] = time.perf_counter()
+        for seq in range(commands):
+            server.send(client, ':user!u@host PRIVMSG #c%d :!work %d %d' % (
+                    seq % channels, seq, loops))
+            if seq % 100 == 0:
+                await client['writer'].drain()
+
+    ready = threading.Event()
+    loop = asyncio.new_event_loop()
+
+    def serve():
+        asyncio.set_event_loop(loop)
+        server = FakeServer(onClient=onClient, onLine=onLine)
+        bot.port = loop.run_until_complete(server.start())
+        ready.set()
+        loop.run_forever()
+
+    threading.Thread(target=serve, daemon=True).start()
+    ready.wait()
+    threading.Thread(target=bot, daemon=True).start()
+    finished = done.wait(120)
+    elapsed = time.perf_counter() - state['start']
+    ordered = all(seqs == sorted(seqs) for seqs in replies.values())
+    bot.disconnect()
+    loop.call_soon_threadsafe(loop.stop)
+    return {
+            'mode': 'broker' if workers else 'threads',
+            'workers': workers,
+            'threads': threads,
+            'commands': commands,
+            'replies': state['count'],
+            'complete': finished,
+            'ordered_per_channel': ordered,
+            'secs': round(elapsed, 3),
+            'commands_per_sec': round(state['count'] / elapsed, 1)
+            }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--workers', default='0,2,4')
+    parser.add_argument('--commands', type=int, default=2000)
+    parser.add_argument('--channels', type=int, default=16)
+    parser.add_argument('--loops', type=int, default=20000)
+    parser.add_argument('--threads', type=int, default=4)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+    for workers in args.workers.split(','):
+        print(json.dumps(run(
+                int(workers), args.commands, args.channels, args.loops,
+                args.threads
+                )), flush=True)
+
+
+if __name__ == '__main__':
+    main()
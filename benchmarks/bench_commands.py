@@ -0,0 +1,90 @@
+""" Scaling of command matching: linear regex scan vs CommandIndex """
+import argparse
+import random
+import re
+import time
+
+from stirbot import CommandHandle
+from stirbot.matcher import CommandIndex
+
+from traffic import WORDS
+
+
+def makeCommands(count, seed=1):
+    """ A mix of trigger, keyword, alternation and case-insensitive commands """
+    rand = random.Random(seed)
+    commands = {}
+    for i in range(count):
+        roll = rand.random()
+        if roll < 0.6:
+            regex = r'^!cmd%d\b ?(.*)' % i
+        elif roll < 0.85:
+            regex = r'\bword%d\b' % i
+        elif roll < 0.95:
+            regex = r'foo%d (\w+)|bar%d (\w+)' % (i, i)
+        else:
+            regex = r'(?i)^tellme%d (.*)' % i
+        handle = CommandHandle(regex, None)
+        handle.cregex = [re.compile(item) for item in handle.regex]
+        commands['cmd%d' % i] = handle
+    return commands
+
+
+def makeMessages(count, commands, seed=2):
+    """ Mostly chatter, with a few percent of lines hitting a command """
+    rand = random.Random(seed)
+    size = len(commands)
+    messages = []
+    for _ in range(count):
+        text = ' '.join(rand.choice(WORDS) for _ in range(rand.randint(1, 20)))
+        roll = rand.random()
+        if roll < 0.03:
+            text = '!cmd%d %s' % (rand.randrange(size), text)
+        elif roll < 0.05:
+            text = '%s word%d' % (text, rand.randrange(size))
+        messages.append(text)
+    return messages
+
+
+def linear(commands, message):
+    for name in commands:
+        for regex in commands[name].cregex:
+            match = regex.search(message)
+            if match:
+                return name, match
+    return None
+
+
+def rate(func, messages):
+    start = time.perf_counter()
+    for message in messages:
+        func(message)
+    return len(messages) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--messages', type=int, default=5000)
+    parser.add_argument('--sizes', default='10,100,1000')
+    args = parser.parse_args()
+    print('%8s %14s %14s %14s' % ('commands', 'linear/s', 'index/s', 'combined/s'))
+    for size in [int(size) for size in args.sizes.split(',')]:
+        commands = makeCommands(size)
+        messages = makeMessages(args.messages, commands)
+        index = CommandIndex(commands)
+        combined = CommandIndex(commands, combine=True)
+        for message in messages:
+            expect = linear(commands, message)
+            for matcher in (index, combined):
+                got = matcher.match(message)
+                assert (expect and expect[0]) == (got and got[0]), message
+        results = [
+                rate(lambda message: linear(commands, message), messages),
+                rate(index.match, messages),
+                rate(combined.match, messages)
+                ]
+        print('%8d %14.0f %14.0f %14.0f' % tuple([size] + results))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+""" Lines/sec for the old regex scan vs the tokenizer + handler table """
+import argparse
+import re
+import time
+
+from stirbot import IRCServer
+
+from traffic import busyChannel
+
+NICK = 'stirbot'
+
+# the _serverRe table _sniffLine used to scan for every line, in order
+LEGACY = [
+        r'^:(.*) 002 (.*) :.*',
+        r'^PING :(.*)',
+        r'^:(.*)!(.*) PRIVMSG (.*) :(.*)',
+        r'^:(.*)!(.*) NOTICE (.*) :(.*)',
+        r'^:(.*) 332 %s (.*) :(.*)' % NICK,
+        r'^:(.*) TOPIC (.*) :(.*)',
+        r'^:.* 353 %s . (.*) :(.*)' % NICK,
+        r'^:(.*)!.* QUIT :',
+        r'^:.* MODE (.*) \+([A-Za-z]) (.*)',
+        r'^:.* MODE (.*) -([A-Za-z]) (.*)',
+        r'^:(.*)!.* JOIN (.*)',
+        r'^:(.*)!.* PART (.*) :.*',
+        r'^:(.+) NOTICE %s :(.+) ACC (\d)(.*)?' % NICK,
+        r'^:(.+) NOTICE (.+) :You are now identified for',
+        ]
+
+
+def noop(*args):
+    pass
+
+
+def legacy():
+    cregex = [re.compile(item) for item in LEGACY]
+    def run(lines):
+        for line in lines:
+            for item in cregex:
+                if item.search(line):
+                    noop(line)
+                    break
+    return run
+
+
+def tokenized():
+    bot = IRCServer(NICK, threads=1)
+    for command in bot._serverCmds:
+        bot._serverCmds[command] = noop
+    sniff = bot._sniffLine
+    def run(lines):
+        for line in lines:
+            sniff(line)
+    return run
+
+
+def timeit(func, lines, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(lines)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return len(lines) / best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--file', help='recorded server log (one line each)')
+    parser.add_argument('--lines', type=int, default=50000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    if args.file:
+        with open(args.file, encoding='utf-8', errors='replace') as f:
+            lines = [line.rstrip('\r\n') for line in f if line.strip()]
+    else:
+        lines = list(busyChannel(args.lines))
+    old = timeit(legacy(), lines, args.repeat)
+    new = timeit(tokenized(), lines, args.repeat)
+    print('regex scan: %10.0f lines/sec' % old)
+    print('tokenizer:  %10.0f lines/sec (%.1fx)' % (new, new / old))
+
+
+if __name__ == '__main__':
+    main()
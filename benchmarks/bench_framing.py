@@ -0,0 +1,42 @@
+""" Feeds a server stream through LineBuffer in random chunk sizes """
+import argparse
+import random
+import time
+
+from stirbot.framing import LineBuffer
+
+from traffic import busyChannel, stream
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--file', help='recorded raw server stream')
+    parser.add_argument('--lines', type=int, default=100000)
+    parser.add_argument('--max-chunk', type=int, default=4096)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    if args.file:
+        with open(args.file, 'rb') as f:
+            data = f.read()
+    else:
+        data = stream(busyChannel(args.lines))
+    expected = len([l for l in data.split(b'\n') if l.strip(b'\r')])
+    rand = random.Random(args.seed)
+    chunks, pos = [], 0
+    while pos < len(data):
+        size = rand.randint(1, args.max_chunk)
+        chunks.append(data[pos:pos + size])
+        pos += size
+    buf, count = LineBuffer(), 0
+    start = time.perf_counter()
+    for chunk in chunks:
+        buf.feed(chunk)
+        count += len(buf.lines())
+    elapsed = time.perf_counter() - start
+    print('%.1f MB in %d chunks, %d lines (expected %d)' % (
+            len(data) / 1e6, len(chunks), count, expected))
+    print('%.0f lines/sec' % (count / elapsed))
+
+
+if __name__ == '__main__':
+    main()
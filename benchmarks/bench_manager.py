@@ -0,0 +1,81 @@
+""" Memory and threads per connection for BotManager at 1/10/100 sessions """
+import argparse
+import asyncio
+import json
+import logging
+import subprocess
+import sys
+import threading
+import time
+
+from stirbot import BotManager
+
+
+def rss():
+    """ Resident memory of this process in kB """
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return 0
+
+
+async def child(sessions, port):
+    manager = BotManager()
+    manager.addCommand('hello', r'^!hello', lambda *args: None)
+    before, threads = rss(), threading.active_count()
+    for i in range(sessions):
+        manager.addNetwork(
+                'net%d' % i, 'bot%d' % i, host='127.0.0.1', autojoin=['#bench']
+                )
+    for server in manager.networks.values():
+        server.port = port
+    runner = asyncio.ensure_future(manager.run())
+    start = time.perf_counter()
+    while not all(server.servHost for server in manager.networks.values()):
+        await asyncio.sleep(0.05)
+        if time.perf_counter() - start > 60:
+            raise RuntimeError('sessions did not register')
+    elapsed = time.perf_counter() - start
+    result = {
+            'sessions': sessions,
+            'register_secs': round(elapsed, 3),
+            'rss_kb': rss(),
+            'rss_kb_per_session': round((rss() - before) / sessions, 1),
+            'threads': threading.active_count(),
+            'threads_per_session': round(
+                    (threading.active_count() - threads) / sessions, 3)
+            }
+    for name in list(manager.networks):
+        manager.removeNetwork(name)
+    await runner
+    print(json.dumps(result))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', default='1,10,100')
+    parser.add_argument('--child', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        logging.basicConfig(level=logging.ERROR)
+        asyncio.run(child(args.child, args.port))
+        return
+    server = subprocess.Popen(
+            [sys.executable, 'fakeserver.py'], stdout=subprocess.PIPE, text=True
+            )
+    try:
+        port = int(server.stdout.readline())
+        for size in args.sizes.split(','):
+            # every size runs in a fresh process so the numbers don't mix
+            subprocess.check_call([
+                    sys.executable, __file__, '--child', size,
+                    '--port', str(port)
+                    ])
+    finally:
+        server.terminate()
+
+
+if __name__ == '__main__':
+    main()
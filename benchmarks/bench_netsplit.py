@@ -0,0 +1,128 @@
+"""
+Replays a netsplit (every user QUITs) on the old list model, on Membership
+line by line and on Membership as one IRCv3 netsplit batch
+"""
+import argparse
+import logging
+import random
+import time
+
+from stirbot import IRCServer
+
+
+class LegacyChannel(object):
+    """ The Channel model before Membership (lists for ops/voices) """
+    def __init__(self):
+        self.users = {}
+        self.ops = []
+        self.voices = []
+
+
+def legacyNames(channels, channel, names):
+    """ The old _updateNames for one 353 line """
+    if channel not in channels:
+        channels[channel] = LegacyChannel()
+    for name in names:
+        if name[0] == '@':
+            name = name[1:]
+            if name not in channels[channel].ops:
+                channels[channel].ops.append(name)
+        if name[0] == '+':
+            name = name[1:]
+            if name not in channels[channel].voices:
+                channels[channel].voices.append(name)
+        if name not in channels[channel].users:
+            channels[channel].users[name] = 0
+
+
+def legacyQuit(channels, nick):
+    """ The old _somebodyQuit loop (with list.remove, del list[str] raised) """
+    for channel in channels:
+        if nick in channels[channel].users:
+            del channels[channel].users[nick]
+        if nick in channels[channel].ops:
+            channels[channel].ops.remove(nick)
+        if nick in channels[channel].voices:
+            channels[channel].voices.remove(nick)
+
+
+def makeNames(users, channels, seed=1):
+    """ {channel: [prefixed names]} with every user in 1-5 channels """
+    rand = random.Random(seed)
+    names = {'#chan%d' % i: [] for i in range(channels)}
+    for i in range(users):
+        for channel in rand.sample(sorted(names), rand.randint(1, 5)):
+            prefix = rand.choice(['@'] + ['+'] * 3 + [''] * 16)
+            names[channel].append('%suser%d' % (prefix, i))
+    return names
+
+
+def chunks(names, size=50):
+    for i in range(0, len(names), size):
+        yield names[i:i + size]
+
+
+def loadNames(bot, names):
+    """ Feeds the NAMES replies through _sniffLine, returns the time """
+    start = time.perf_counter()
+    for channel, chanNames in names.items():
+        for chunk in chunks(chanNames):
+            bot._sniffLine(':irc.example.net 353 stirbot = %s :%s' % (
+                    channel, ' '.join(chunk)))
+        bot._sniffLine(':irc.example.net 366 stirbot %s :End of /NAMES list.' %
+                channel)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--channels', type=int, default=50)
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+    names = makeNames(args.users, args.channels)
+    quits = ['user%d' % i for i in range(args.users)]
+
+    channels = {}
+    start = time.perf_counter()
+    for channel, chanNames in names.items():
+        for chunk in chunks(chanNames):
+            legacyNames(channels, channel, chunk)
+    legacyLoad = time.perf_counter() - start
+    start = time.perf_counter()
+    for nick in quits:
+        legacyQuit(channels, nick)
+    legacySplit = time.perf_counter() - start
+
+    bot = IRCServer('stirbot', threads=1)
+    load = loadNames(bot, names)
+    assert len(bot.members.users) == args.users
+    lines = [':%s!~%s@host QUIT :*.net *.split' % (nick, nick) for nick in quits]
+    start = time.perf_counter()
+    for line in lines:
+        bot._sniffLine(line)
+    split = time.perf_counter() - start
+    assert not bot.members.users
+    assert not any(channel.members for channel in bot.channels.values())
+
+    bot = IRCServer('stirbot', threads=1)
+    batchLoad = loadNames(bot, names)
+    lines = ['@batch=split1 %s' % line for line in lines]
+    start = time.perf_counter()
+    bot._sniffLine(':irc.example.net BATCH +split1 netsplit *.net *.split')
+    for line in lines:
+        bot._sniffLine(line)
+    bot._sniffLine(':irc.example.net BATCH -split1')
+    batchSplit = time.perf_counter() - start
+    assert not bot.members.users
+    assert not any(channel.members for channel in bot.channels.values())
+
+    print('%d users in %d channels' % (args.users, args.channels))
+    print('%12s %12s %12s' % ('', 'NAMES (s)', 'netsplit (s)'))
+    print('%12s %12.3f %12.3f' % ('lists', legacyLoad, legacySplit))
+    print('%12s %12.3f %12.3f' % ('membership', load, split))
+    print('%12s %12.3f %12.3f' % ('batch', batchLoad, batchSplit))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+""" Time to first PRIVMSG for a one-shot notifier script """
+import argparse
+import asyncio
+import json
+import subprocess
+import sys
+import threading
+import time
+
+from fakeserver import FakeServer
+
+# connects, registers, says one thing and waits to be killed
+NOTIFIER = '''
+import time
+start = time.perf_counter()
+import stirbot
+imported = time.perf_counter()
+import json, sys, threading
+bot = stirbot.IRCServer('notifier', '127.0.0.1', autojoin=[])
+bot.port = %d
+bot.connect()
+threading.Thread(target=bot._listen, daemon=True).start()
+bot.auth(bot.nick)
+bot.sendMessage('#alerts', 'deploy finished')
+sent = time.perf_counter()
+print(json.dumps({
+        'import_ms': (imported - start) * 1000,
+        'sent_ms': (sent - start) * 1000,
+        'threads': threading.active_count()
+        }), flush=True)
+sys.stdin.read()
+'''
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * pct))], 2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--runs', type=int, default=10)
+    args = parser.parse_args()
+    received = threading.Event()
+    stamp = {}
+
+    def onLine(server, client, line):
+        if line.startswith('PRIVMSG '):
+            stamp['privmsg'] = time.perf_counter()
+            received.set()
+
+    ready = threading.Event()
+    loop = asyncio.new_event_loop()
+    server = FakeServer(onLine=onLine)
+
+    def serve():
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(server.start())
+        ready.set()
+        loop.run_forever()
+
+    threading.Thread(target=serve, daemon=True).start()
+    ready.wait()
+    results = {'interpreter': [], 'privmsg': [], 'import': [], 'threads': []}
+    for _ in range(args.runs):
+        start = time.perf_counter()
+        subprocess.check_call([sys.executable, '-c', 'pass'])
+        results['interpreter'].append((time.perf_counter() - start) * 1000)
+        received.clear()
+        start = time.perf_counter()
+        child = subprocess.Popen(
+                [sys.executable, '-c', NOTIFIER % server.port],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True
+                )
+        if not received.wait(30):
+            child.kill()
+            raise RuntimeError('the notifier never sent its PRIVMSG')
+        results['privmsg'].append((stamp['privmsg'] - start) * 1000)
+        report = json.loads(child.stdout.readline())
+        results['import'].append(report['import_ms'])
+        results['threads'].append(report['threads'])
+        child.stdin.close()
+        child.wait()
+    loop.call_soon_threadsafe(loop.stop)
+    print(json.dumps({
+            'runs': args.runs,
+            'interpreter_ms_p50': percentile(results['interpreter'], 0.5),
+            'import_ms_p50': percentile(results['import'], 0.5),
+            'first_privmsg_ms_p50': percentile(results['privmsg'], 0.5),
+            'first_privmsg_ms_p90': percentile(results['privmsg'], 0.9),
+            'threads': max(results['threads']),
+            'python': sys.version.split()[0]
+            }))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+""" Minimal local IRC server for driving the bot in benchmarks """
+import argparse
+import asyncio
+
+SERVER = 'fake.server'
+CAPABILITIES = (
+        'multi-prefix', 'userhost-in-names', 'away-notify', 'message-tags',
+        'batch', 'sasl'
+        )
+
+
+class FakeServer(object):
+    """
+    Registers clients, echoes their JOINs, answers PINGs and hands every
+    connection to <onClient> (a coroutine taking (server, client)) once the
+    client has registered, every line a client sends is also passed to
+    <onLine> (server, client, line). Capabilities are offered and acked
+    (the server itself only speaks SASL, with any credentials) and
+    clients that ask for them are welcomed after CAP END.
+    """
+    def __init__(self, host='127.0.0.1', port=0, onClient=None, onLine=None):
+        self.host, self.port = host, port
+        self.onClient, self.onLine = onClient, onLine
+        self.clients = []
+        self.received = 0
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(
+                self._handle, self.host, self.port
+                )
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self.port
+
+    async def close(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _handle(self, reader, writer):
+        client = {
+                'nick': None, 'writer': writer, 'reader': reader,
+                'cap': False, 'welcomed': False
+                }
+        self.clients.append(client)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                self.received += 1
+                line = line.decode('utf-8', 'replace').rstrip('\r\n')
+                if self.onLine is not None:
+                    self.onLine(self, client, line)
+                words = line.split(' ')
+                command = words[0].upper()
+                if command == 'NICK':
+                    client['nick'] = words[1]
+                    if not client['cap']:
+                        self._welcome(client)
+                elif command == 'CAP':
+                    if words[1] == 'LS':
+                        client['cap'] = True
+                        self.send(client, ':%s CAP * LS :%s' % (
+                                SERVER, ' '.join(CAPABILITIES)))
+                    elif words[1] == 'REQ':
+                        client['cap'] = True
+                        self.send(client, ':%s CAP * ACK :%s' % (
+                                SERVER, ' '.join(words[2:]).lstrip(':')))
+                    elif words[1] == 'END':
+                        client['cap'] = False
+                        self._welcome(client)
+                elif command == 'AUTHENTICATE':
+                    if words[1] == 'PLAIN':
+                        self.send(client, 'AUTHENTICATE +')
+                    else:
+                        self.send(client, ':%s 903 %s :SASL successful' % (
+                                SERVER, client['nick'] or '*'))
+                elif command == 'JOIN':
+                    for chan in words[1].lstrip(':').split(','):
+                        self.send(client, ':%s!~%s@localhost JOIN %s' % (
+                                client['nick'], client['nick'], chan))
+                elif command == 'PING':
+                    self.send(client, ':%s PONG %s :%s' % (
+                            SERVER, SERVER, words[-1].lstrip(':')))
+                elif command == 'QUIT':
+                    break
+        finally:
+            self.clients.remove(client)
+            writer.close()
+
+    def _welcome(self, client):
+        if client['welcomed'] or client['nick'] is None:
+            return
+        client['welcomed'] = True
+        nick = client['nick']
+        self.send(client, ':%s 001 %s :Welcome' % (SERVER, nick))
+        self.send(client, ':%s 002 %s :Your host is %s' % (SERVER, nick, SERVER))
+        if self.onClient is not None:
+            asyncio.ensure_future(self.onClient(self, client))
+
+    def send(self, client, line):
+        client['writer'].write(('%s\r\n' % line).encode('utf-8'))
+
+
+async def serve(host, port):
+    server = FakeServer(host, port)
+    port = await server.start()
+    print(port, flush=True)
+    await asyncio.Event().wait()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=0)
+    args = parser.parse_args()
+    asyncio.run(serve(args.host, args.port))
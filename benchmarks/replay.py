@@ -0,0 +1,244 @@
+""" Replays server traffic into a real bot over loopback and times it """
+import argparse
+import asyncio
+import json
+import logging
+import platform
+import subprocess
+import sys
+import time
+
+from fakeserver import FakeServer
+from traffic import busyChannel, namesFlood, netsplit
+
+CHANNEL = '#stirbot'
+SCENARIOS = ('busy', 'names', 'netsplit', 'load')
+
+
+def scenario(name, args):
+    """
+    Yields (lines, marker every, ping every) for a scenario, markers are
+    '!bench <id>' commands the bot answers, pings are timed PING/PONGs
+    """
+    if name == 'file':
+        with open(args.file, 'rb') as f:
+            lines = [line.decode('utf-8', 'replace').rstrip('\r')
+                     for line in f.read().split(b'\n') if line.strip(b'\r')]
+        return lines, 100, 1000
+    if name == 'busy':
+        return busyChannel(args.lines), 100, 1000
+    if name == 'names':
+        return namesFlood(args.channels, args.users), 100, 1000
+    if name == 'netsplit':
+        return netsplit(args.users), 100, 1000
+    if name == 'load':
+        # handlers busy on every 10th line, pings every 200
+        return busyChannel(args.lines), 10, 200
+    raise ValueError('unknown scenario %s' % name)
+
+
+def percentiles(values):
+    """ p50/p90/p99/max of <values> (seconds) in ms """
+    if not values:
+        return None
+    values = sorted(values)
+    pick = lambda p: values[min(len(values) - 1, int(len(values) * p))]
+    return {
+            'count': len(values),
+            'p50': round(pick(0.50) * 1000, 3),
+            'p90': round(pick(0.90) * 1000, 3),
+            'p99': round(pick(0.99) * 1000, 3),
+            'max': round(values[-1] * 1000, 3)
+            }
+
+
+def memory(pid):
+    """ (VmRSS, VmHWM) of process <pid> in kB """
+    found = {}
+    with open('/proc/%d/status' % pid) as f:
+        for line in f:
+            key = line.split(':', 1)[0]
+            if key in ('VmRSS', 'VmHWM'):
+                found[key] = int(line.split()[1])
+    return found.get('VmRSS', 0), found.get('VmHWM', 0)
+
+
+def revision():
+    """ Git revision of the tree being measured (if there is one) """
+    try:
+        return subprocess.check_output(
+                ['git', 'rev-parse', '--short', 'HEAD'],
+                stderr=subprocess.DEVNULL, text=True
+                ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Replay(object):
+    """
+    Feeds <lines> to the first client of a FakeServer, every <markEvery>
+    line is replaced by a '!bench <id>' command and every <pingEvery>
+    line gets a 'PING :p<id>' in front of it. The bot's replies and PONGs
+    are timed against when the line went out, a final PING tells when
+    every line has been read.
+    """
+    def __init__(self, lines, markEvery, pingEvery, chunk=65536):
+        self.lines, self.chunk = lines, chunk
+        self.markEvery, self.pingEvery = markEvery, pingEvery
+        self.sentAt, self.pingAt = {}, {}
+        self.handler, self.pong = [], []
+        self.total = 0
+        self.start = self.end = None
+        self.joined = asyncio.Event()
+        self.done = asyncio.Event()
+
+    def onLine(self, server, client, line):
+        """ Times the bot's PONGs and command replies """
+        now = time.perf_counter()
+        words = line.split(' ', 2)
+        if words[0] == 'JOIN':
+            self.joined.set()
+        elif words[0] == 'PONG':
+            token = words[-1].lstrip(':')
+            if token == 'done':
+                self.end = now
+                self.done.set()
+            elif token in self.pingAt:
+                self.pong.append(now - self.pingAt.pop(token))
+        elif words[0] == 'PRIVMSG' and words[-1].startswith(':bench '):
+            stamp = self.sentAt.pop(words[-1][7:], None)
+            if stamp is not None:
+                self.handler.append(now - stamp)
+
+    async def onClient(self, server, client):
+        """ Writes the traffic in chunks as fast as the bot reads it """
+        await self.joined.wait()
+        writer = client['writer']
+        marks, pings, size, parts = [], [], 0, []
+        self.start = time.perf_counter()
+        for i, line in enumerate(self.lines):
+            if i % self.pingEvery == 0:
+                token = 'p%d' % i
+                pings.append(token)
+                parts.append('PING :%s\r\n' % token)
+            if i % self.markEvery == 0:
+                marks.append(str(i))
+                line = ':bench!~bench@localhost PRIVMSG %s :!bench %d' % (
+                        CHANNEL, i)
+            part = '%s\r\n' % line
+            parts.append(part)
+            size += len(part)
+            self.total += 1
+            if size >= self.chunk:
+                await self._write(writer, parts, marks, pings)
+                marks, pings, size, parts = [], [], 0, []
+        parts.append('PING :done\r\n')
+        await self._write(writer, parts, marks, pings)
+
+    async def _write(self, writer, parts, marks, pings):
+        now = time.perf_counter()
+        for mark in marks:
+            self.sentAt[mark] = now
+        for token in pings:
+            self.pingAt[token] = now
+        writer.write(''.join(parts).encode('utf-8'))
+        await writer.drain()
+
+    async def settle(self, timeout):
+        """ Waits for the replies still on their way after the last line """
+        deadline = time.perf_counter() + timeout
+        while self.sentAt and time.perf_counter() < deadline:
+            await asyncio.sleep(0.05)
+
+
+def bot(port, engine, threads, metrics=False):
+    """ Runs the bot under test (in its own process) """
+    logging.basicConfig(level=logging.ERROR)
+    from stirbot import IRCServer, AsyncIRCServer
+    cls = AsyncIRCServer if engine == 'async' else IRCServer
+    server = cls(
+            'stirbot', host='127.0.0.1', autojoin=[CHANNEL], threads=threads,
+            floodrate=None, metrics=metrics
+            )
+    server.port = port
+
+    def bench(chan, nick, host, match):
+        server.sendMessage(chan, 'bench %s' % match.group(1))
+    server.addCommand('bench', r'^!bench (\d+)', bench)
+    server()
+
+
+async def measure(name, args):
+    lines, markEvery, pingEvery = scenario(name, args)
+    replay = Replay(lines, markEvery, pingEvery)
+    server = FakeServer(onClient=replay.onClient, onLine=replay.onLine)
+    port = await server.start()
+    child = await asyncio.create_subprocess_exec(
+            sys.executable, __file__, '--bot', str(port),
+            '--engine', args.engine, '--threads', str(args.threads),
+            *(['--metrics'] if args.metrics else [])
+            )
+    try:
+        await asyncio.wait_for(replay.done.wait(), args.timeout)
+        await replay.settle(args.settle)
+        rss, peak = memory(child.pid)
+    finally:
+        child.terminate()
+        await child.wait()
+        await server.close()
+    elapsed = replay.end - replay.start
+    return {
+            'scenario': name,
+            'engine': args.engine,
+            'threads': args.threads,
+            'metrics': args.metrics,
+            'lines': replay.total,
+            'secs': round(elapsed, 3),
+            'lines_per_sec': round(replay.total / elapsed),
+            'handler_ms': percentiles(replay.handler),
+            'handler_lost': len(replay.sentAt),
+            'pong_ms': percentiles(replay.pong),
+            'pong_lost': len(replay.pingAt),
+            'rss_kb': rss,
+            'rss_peak_kb': peak,
+            'revision': revision(),
+            'python': platform.python_version(),
+            'time': int(time.time())
+            }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+            '--scenarios', default=','.join(SCENARIOS),
+            help='comma separated, from %s' % ', '.join(SCENARIOS)
+            )
+    parser.add_argument('--file', help='recorded raw server stream to replay')
+    parser.add_argument('--engine', choices=('thread', 'async'), default='thread')
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument(
+            '--metrics', action='store_true', help='run the bot with metrics on'
+            )
+    parser.add_argument('--lines', type=int, default=100000)
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--channels', type=int, default=20)
+    parser.add_argument('--timeout', type=float, default=300)
+    parser.add_argument('--settle', type=float, default=5)
+    parser.add_argument('--out', help='append the JSON results to this file')
+    parser.add_argument('--bot', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.bot:
+        bot(args.bot, args.engine, args.threads, args.metrics)
+        return
+    names = ['file'] if args.file else args.scenarios.split(',')
+    for name in names:
+        # every scenario gets a fresh bot so memory numbers don't mix
+        result = asyncio.run(measure(name, args))
+        print(json.dumps(result), flush=True)
+        if args.out:
+            with open(args.out, 'a') as f:
+                f.write(json.dumps(result) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+""" Synthetic server traffic shared by the benchmarks """
+import random
+
+WORDS = (
+        'the quick brown fox jumps over lazy dog irc bot stir python '
+        'channel nick server ping pong hello why été über '
+        '日本 \U0001f600'
+        ).split()
+
+
+def busyChannel(lines=100000, channels=('#stirbot', '#python', '#linux'),
+                nicks=500, seed=1):
+    """ Yields raw server lines for a handful of busy channels """
+    rand = random.Random(seed)
+    users = ['user%d' % i for i in range(nicks)]
+    for i in range(lines):
+        nick, chan = rand.choice(users), rand.choice(channels)
+        roll = rand.random()
+        if roll < 0.85:
+            text = ' '.join(rand.choice(WORDS) for _ in range(rand.randint(1, 20)))
+            yield ':%s!~%s@host-%d.example.net PRIVMSG %s :%s' % (
+                    nick, nick, i % 97, chan, text)
+        elif roll < 0.90:
+            yield ':%s!~%s@host.example.net JOIN %s' % (nick, nick, chan)
+        elif roll < 0.95:
+            yield ':%s!~%s@host.example.net PART %s :bye' % (nick, nick, chan)
+        elif roll < 0.98:
+            yield ':%s!~%s@host.example.net QUIT :Quit: leaving' % (nick, nick)
+        else:
+            yield 'PING :irc.example.net'
+
+
+def stream(lines):
+    """ Joins raw lines into the bytes a server would send """
+    return ''.join('%s\r\n' % line for line in lines).encode('utf-8')
+
+
+def namesFlood(channels=20, users=2000, nick='stirbot', seed=1):
+    """ Big NAMES replies (353 x N + 366) for a batch of channels """
+    rand = random.Random(seed)
+    for c in range(channels):
+        chan = '#names%d' % c
+        names = ['%suser%d' % (rand.choice(['', '', '', '+', '@']), i)
+                 for i in range(users)]
+        for i in range(0, len(names), 60):
+            yield ':irc.example.net 353 %s = %s :%s' % (
+                    nick, chan, ' '.join(names[i:i + 60]))
+        yield ':irc.example.net 366 %s %s :End of /NAMES list.' % (nick, chan)
+
+
+def netsplit(users=10000, channels=('#stirbot', '#python', '#linux'),
+             nick='stirbot'):
+    """ Everyone joins, then a netsplit QUITs them all """
+    for chan in channels:
+        yield ':%s!~%s@host JOIN %s' % (nick, nick, chan)
+        yield ':irc.example.net 366 %s %s :End of /NAMES list.' % (nick, chan)
+    for i in range(users):
+        for chan in channels[:1 + i % len(channels)]:
+            yield ':user%d!~user%d@host JOIN %s' % (i, i, chan)
+    for i in range(users):
+        yield ':user%d!~user%d@host QUIT :*.net *.split' % (i, i)
@@ -1,238 +1,679 @@
 #!/usr/bin/python
 import time
-import re
+import base64
 import logging
+import os
 import socket
 import ssl
-from logging.handlers import RotatingFileHandler
-from multiprocessing.dummy import Pool, Process
-from multiprocessing import cpu_count
+import threading
+from concurrent.futures import CancelledError, TimeoutError as FutureTimeout
+
+from .framing import LineBuffer
+from .parser import parseLine
+from .matcher import CommandIndex, compilePattern
+from .sendq import SendQueue, MAXLINE
+from .workers import SerialPool
+from .metrics import Metrics, MetricsServer, prometheus, isCoroutineFunction
+from .log import log, trace, Lazy, queueLogging
+from .backoff import Backoff, candidates
+from .offload import Match, ProcessOffload
+from .limits import RateLimit, Cooldown, ResultCache, allow
+from .accounts import AccountCache
+from .channels import (
+        Channel, Membership, MODEFLAGS, OP, VOICE, DEFAULTPREFIX,
+        parseNames, parsePrefix
+        )
 
 SSLPORTS = [6697, 7000, 7070]
 NONSSLPORTS = [6665, 6666, 6667, 8000, 8001, 8002]
+# channel modes that always take a parameter / only take one when set,
+# until the server's 005 (CHANMODES, PREFIX) tells us its own
+PARAMMODES = 'ovhqabeIkOV'
+SETPARAMMODES = 'lfjJ'
+# IRCv3 capabilities we ask for when the server offers them
+CAPABILITIES = (
+        'multi-prefix', 'userhost-in-names', 'away-notify', 'message-tags',
+        'batch', 'account-notify', 'extended-join'
+        )
+# SASL failure numerics (nick locked, failed, too long, aborted, limit)
+SASLFAILED = ('902', '904', '905', '906', '908')
+# traceChannel() name that traces every line
+TRACEALL = '*'
+# default command threads: enough to overlap slow (network bound)
+# commands, they are only started once there is work for them
+THREADS = min(32, (os.cpu_count() or 1) + 4)
+
+
+def _countFlags(members, flag):
+    """ How many of {'nick': flags} have <flag> """
+    return sum(1 for flags in members.values() if flags & flag)
 
 class CommandHandle(object):
-    """ Base Class for commands """
-    def __init__(self, regex, function):
+    """
+    Base Class for commands
+
+    executor='process' runs the function in a worker process (see
+    offload.ProcessOffload), at most <maxjobs> at once for <timeout>
+    seconds each
+
+    <limit> is a limits.RateLimit (or a list of them, they can be shared
+    between commands) and <cooldown> the seconds between two calls of the
+    same nick (or a limits.Cooldown), calls over the limit are dropped
+    before they take a worker. With <cache> (a limits.ResultCache or its
+    ttl in seconds) what the function returns is sent as messages and kept
+    for the next call with the same match groups.
+    """
+    def __init__(
+                self, regex, function, executor=None, timeout=30, maxjobs=4,
+                limit=None, cooldown=None, cache=None
+                ):
         if not isinstance(regex, list):
             regex = [regex]
         self.regex = regex
         self.function = function
         self.cregex = []
+        self.executor, self.timeout, self.maxjobs = executor, timeout, maxjobs
+        if limit is None:
+            limit = []
+        elif isinstance(limit, list):
+            # the caller's list (maybe shared) stays as it is
+            limit = list(limit)
+        else:
+            limit = [limit]
+        if cooldown is not None and not isinstance(cooldown, RateLimit):
+            cooldown = Cooldown(cooldown)
+        if cooldown is not None:
+            limit.append(cooldown)
+        if cache is not None and not isinstance(cache, ResultCache):
+            cache = ResultCache(cache)
+        self.limits, self.cache = limit, cache
+
+    def allow(self, chan, nick, host):
+        """ Takes a token from each limit, False if the call is over one """
+        return not self.limits or allow(self.limits, chan, nick, host)
+
+    def stats(self):
+        """ The limits and the cache """
+        stats = {}
+        if self.limits:
+            stats['limits'] = [limit.stats() for limit in self.limits]
+        if self.cache is not None:
+            stats['cache'] = self.cache.stats()
+        return stats
+
+
+def _compileHandle(handle):
+    """ Compiles the regex of a CommandHandle """
+    log.debug(handle.regex)
+    handle.cregex = [compilePattern(item) for item in handle.regex]
+
+
+class CommandSet(object):
+    """
+    A commands dict ({name: CommandHandle}) with its matching index and
+    the process pool for executor='process' commands (IRCServer and
+    BotManager), needs commands, combine, _commandIndex, _commandsLock
+    and _offload attributes
+    """
+    def loadCommands(self, commands):
+        """
+        Loads a dict as self.commands and compiles regex (overwrites all)
+        """
+        log.info('Loading commands')
+        self.updateCommands(commands, list(self.commands))
+
+    def addCommand(self, name, regex, func, **options):
+        """
+        Add a command to the self.commands dict
+        (overwrites commands with the same <name>)
+        <options> (executor, timeout, maxjobs, limit, cooldown, cache) are
+        passed to CommandHandle
+        """
+        self.updateCommands({name: CommandHandle(regex, func, **options)})
+        log.info('Command: %s added!', name)
 
-class Channel(object):
-    """ Base class for channels"""
-    def __init__(self):
-        self.users = {}
-        #{'name': 'ACC level'},
-        self.ops = []
-        self.voices = []
-        self.modes = []
-        self.topic = ""
-
-class IRCServer(object):
-    """ Manages Irc server connection """
+    def removeCommand(self, name):
+        """ Remove <name> command from the self.commands dict """
+        if name not in self.commands:
+            raise KeyError(name)
+        self.updateCommands(remove=[name])
+        log.info('Command: %s removed!', name)
+
+    def updateCommands(self, add=None, remove=()):
+        """
+        Adds (or replaces) the {name: CommandHandle} in <add> and removes
+        the names in <remove> in one go: the new commands dict and index
+        are built aside (only the new handles are compiled) and swapped
+        in, a message is matched against all old or all new commands
+        """
+        with self._commandsLock:
+            commands = dict(self.commands)
+            for name in remove:
+                commands.pop(name, None)
+            for name, handle in (add or {}).items():
+                _compileHandle(handle)
+                commands[name] = handle
+            self._setCommands(commands, CommandIndex(commands, self.combine))
+        self._startOffload()
+
+    def _setCommands(self, commands, index):
+        """ Swaps the new commands and their index in (lock held) """
+        self.commands, self._commandIndex = commands, index
+
+    def _compileCommandRe(self, command):
+        """ Compiles single command regex by command name """
+        _compileHandle(self.commands[command])
+
+    def _buildIndex(self):
+        """ Rebuilds the command matching index and swaps it in """
+        self._commandIndex = CommandIndex(self.commands, self.combine)
+
+    def _makeOffload(self):
+        """ Creates the process pool for executor='process' commands """
+        return ProcessOffload()
+
+    def _getOffload(self):
+        """ The process pool, made on first use """
+        if self._offload is None:
+            self._offload = self._makeOffload()
+        return self._offload
+
+    def _startOffload(self):
+        """
+        Starts the process pool if a command needs it, this is done when
+        the command is added so the workers are (usually) forked before
+        the bot starts any threads
+        """
+        if any(handle.executor == 'process' for handle in self.commands.values()):
+            self._getOffload().start()
+
+    def _stopOffload(self):
+        """ Kills the process pool (if there is one) """
+        if self._offload is not None:
+            self._offload.close()
+
+
+class IRCServer(CommandSet):
+    """
+    Manages Irc server connection
+
+    <host> can be a list of hosts, when the connection drops (or can't be
+    made) the bot waits a jittered, growing delay and tries the next host
+    and port (SSLPORTS or NONSSLPORTS), rejoining its channels once back.
+    With <pswrd> the bot identifies with NickServ, or with SASL PLAIN if
+    <sasl> is set. With a <store> (store.Store) the traffic of the
+    channels and their last state are kept in a database.
+    """
     def __init__(
                 self, nick, host="chat.freenode.net",
                 autojoin=['#stirbot'], ssl=False, timeout=60*4,
-                threads=cpu_count()**3, pswrd=False
+                threads=THREADS, pswrd=False, combine=False,
+                floodrate=0.5, floodburst=5, queuesize=1000, overflow='drop',
+                metrics=False, sasl=False, authtimeout=30, store=None
                 ):
-        self.nick, self.host, self.pswrd  = nick, host, pswrd
-        self.ssl, self.threads = ssl, threads
+        if isinstance(host, (list, tuple)):
+            self.hosts = list(host)
+        else:
+            self.hosts = [host]
+        self.nick, self.host, self.pswrd  = nick, self.hosts[0], pswrd
+        self.ssl, self.threads, self.sasl = ssl, threads, sasl
         if not self.ssl:
             self.port = 6666
         else:
             self.port = 7070
         self.timeout, self.threads = timeout, threads
+        self.authtimeout = authtimeout
         self._listenThread = self._sock = None
         self._connected = self._running = self._authed = False
-        self.channels, self.joinChans = {}, autojoin
+        self._authError = None
+        self._backoff = Backoff()
+        # set when registered (001), identified, the connection dropped
+        # and when disconnect() was called
+        self._welcomed, self._authEvent = threading.Event(), threading.Event()
+        self._dropped, self._stopped = threading.Event(), threading.Event()
+        # disconnect() and run() may both close the connection
+        self._closeLock = threading.Lock()
+        self._rejoin = []
+        self.members = Membership()
+        self.channels, self.joinChans = self.members.channels, autojoin
         self.commands = {}
-        self._pool = Pool(int(self.threads))
-        self._listenPool = Pool(int(self.threads))
+        self.combine = combine
+        self._commandIndex = CommandIndex(self.commands)
+        self._commandsLock = threading.Lock()
+        self.queuesize, self.overflow = queuesize, overflow
+        self._workers = self._makeWorkers()
+        self._offload = None
+        self._broker = None
         self.nickserv = 'NickServ!NickServ@services.'
+        self.accounts = AccountCache()
         self.servHost = None
+        self.isupport = {}
+        self._prefixes = dict(DEFAULTPREFIX)
+        self._paramModes, self._setParamModes = PARAMMODES, SETPARAMMODES
+        self._names = {}
+        # capabilities: wanted, offered by the server and enabled
+        self.wantCaps = list(CAPABILITIES)
+        self.caps, self._capsOffered = set(), set()
+        self._capNegotiating = False
+        # open batches {reference: (type, params, [Message])}
+        self._batches = {}
+        self._lineBuffer = LineBuffer()
+        self._traced = set()
+        self.metrics = Metrics(metrics)
+        self.store = store
+        self._metricsServer = None
+        self._sendq = SendQueue(
+                self._write, floodrate, floodburst, self._sendError
+                )
 #-------------------------------------------------------------------------------
-        self._serverRe = {
-                '_002': CommandHandle(r'^:(.*) 002 (.*) :.*', self._got002),
-                '_Ping': CommandHandle(r'^PING :(.*)', self._pong),
-                '_Sniff': CommandHandle(
-                        [
-                            r'^:(.*)!(.*) PRIVMSG (.*) :(.*)',
-                            r'^:(.*)!(.*) NOTICE (.*) :(.*)'
-                        ],
-                        self._sniffMessage
-                        ),
-                '_332': CommandHandle(
-                        [
-                            r'^:(.*) 332 %s (.*) :(.*)' % self.nick,
-                            r'^:(.*) TOPIC (.*) :(.*)'
-                        ],
-                        self._updateTopic
-                        ),
-                '_353': CommandHandle(
-                        r'^:.* 353 %s . (.*) :(.*)' % self.nick,
-                        self._updateNames
-                        ),
-                '_Quit': CommandHandle(
-                        r'^:(.*)!.* QUIT :', self._somebodyQuit
-                        ),
-                '_Modeset':    CommandHandle(
-                        r'^:.* MODE (.*) \+([A-Za-z]) (.*)', self._modeSet
-                        ),
-                '_Modeunset': CommandHandle(
-                        r'^:.* MODE (.*) -([A-Za-z]) (.*)', self._modeUnset
-                        ),
-                '_Join': CommandHandle(
-                        r'^:(.*)!.* JOIN (.*)', self._joinedUser
-                        ),
-                '_Part': CommandHandle(
-                        r'^:(.*)!.* PART (.*) :.*', self._removeUser
-                        ),
-                '_ACC':    CommandHandle(
-                        r'^:(.+) NOTICE %s :(.+) ACC (\d)(.*)?' % self.nick,
-                        self._updateACC
-                        ),
-                '_Identify': CommandHandle(
-                        r'^:(.+) NOTICE (.+) :You are now identified for',
-                        self._identified
-                        )
+        # server commands/numerics are dispatched straight from this table
+        self._serverCmds = {
+                '001': self._welcome,
+                '002': self._got002,
+                '005': self._gotISupport,
+                'PING': self._pong,
+                'PRIVMSG': self._sniffMessage,
+                'NOTICE': self._gotNotice,
+                '332': self._updateTopic,
+                'TOPIC': self._updateTopic,
+                '353': self._updateNames,
+                '366': self._endOfNames,
+                'QUIT': self._somebodyQuit,
+                'MODE': self._gotMode,
+                'JOIN': self._joinedUser,
+                'PART': self._removeUser,
+                'KICK': self._kickedUser,
+                'NICK': self._nickChanged,
+                'CAP': self._gotCap,
+                'AUTHENTICATE': self._gotAuthenticate,
+                'BATCH': self._gotBatch,
+                'AWAY': self._gotAway,
+                'ACCOUNT': self._gotAccount,
+                '903': self._saslDone
                 }
+        for numeric in SASLFAILED:
+            self._serverCmds[numeric] = self._saslFailed
+        # custom regex patterns, only tried for lines with no handler above
+        self._serverRe = {}
+
+    def _makeWorkers(self):
+        """ Creates the pool that runs command functions """
+        return SerialPool(self.threads, self.queuesize, self.overflow)
+
+    def _stopWorkers(self):
+        """ Drops the commands still queued and closes the pool """
+        self._workers.clear()
+        self._workers.close()
+        # its threads only start on demand, if the bot is run again
+        self._workers = self._makeWorkers()
 
-    def _got002(self, match):
+    def _welcome(self, msg):
+        """ 001: we are registered, the connection is good """
+        self.nick = msg.params[0]
+        self._backoff.reset()
+        # the registration lines (CAP, USER, NICK) don't count against
+        # the burst, a notifier can say its first lines right away
+        self._sendq.refill()
+        self._welcomed.set()
+        if self._broker is not None:
+            self._broker.setNick(self.nick)
+
+    def _got002(self, msg):
         """ Fills Serverhost name attribute"""
-        if match.group(2) == self.nick:
-            self.servHost = match.group(1)
-            logging.info("Our server host is: %s" % self.servHost)
+        if msg.params[0] == self.nick:
+            self.servHost = msg.prefix
+            log.info("Our server host is: %s", self.servHost)
+
+    def _gotISupport(self, msg):
+        """ Reads the 005 tokens we care about (PREFIX, CHANMODES) """
+        for token in msg.params[1:-1]:
+            key, _, value = token.partition('=')
+            self.isupport[key] = value
+            if key == 'PREFIX':
+                self._prefixes = parsePrefix(value)
+        # CHANMODES may come in an earlier 005 line than PREFIX
+        chanmodes = self.isupport.get('CHANMODES', '').split(',')
+        if len(chanmodes) >= 4:
+            # type A (lists) and B always take a parameter, C only when set
+            paramModes = chanmodes[0] + chanmodes[1]
+            self._setParamModes = chanmodes[2]
+        else:
+            paramModes = PARAMMODES
+        self._paramModes = ''.join(
+                set(paramModes) | set(self._prefixes.values())
+                )
 
-    def _pong(self, match):
+    def _resetState(self):
+        """ Forgets everything we learned from the server """
+        if self.channels:
+            # joined again after a reconnect
+            self._rejoin = list(self.channels)
+            for channel in self.channels:
+                self._saveChannel(channel)
+        self.servHost = None
+        self.members.clear()
+        self.isupport = {}
+        self._prefixes = dict(DEFAULTPREFIX)
+        self._paramModes, self._setParamModes = PARAMMODES, SETPARAMMODES
+        self._names.clear()
+        self.accounts.clear()
+        self.caps.clear()
+        self._capsOffered.clear()
+        self._capNegotiating = False
+        self._batches.clear()
+
+    def _pong(self, msg):
         """ Pong the Ping """
-        logging.debug(match.group(0))
-        if match.group(1) == self.servHost:
-            self._send("PONG :%s" % self.servHost)
-
-    def _identified(self, match):
-        """ Tells the bot it is authenticated with Nickserv """
-        logging.debug(match.group(0))
-        if match.group(1) == self.nickserv and match.group(2) == self.nick:
-            self._authed = True
-            logging.info('%s is authenticated with Nickserv!' % self.nick)
+        self._send("PONG :%s" % msg.trailing)
+
+    def _gotNotice(self, msg):
+        """ Routes Nickserv notices, everything else is sniffed """
+        if msg.prefix == self.nickserv and msg.params[0] == self.nick:
+            if ' ACC ' in msg.trailing:
+                if self._broker is not None:
+                    # any worker may be waiting on it
+                    self._broker.broadcast(msg.raw)
+                return self._updateACC(msg)
+            if msg.trailing.startswith('You are now identified for'):
+                return self._identified(msg)
+        if msg.userhost:
+            self._sniffMessage(msg)
+
+    def _identified(self, msg):
+        """ Tells the bot (and whoever waits in auth) it is identified """
+        self._authed = True
+        self._authEvent.set()
+        log.info('%s is authenticated!', self.nick)
 
-    def _joinedUser(self, match):
+    def _authFailed(self, reason):
+        """ Tells whoever waits in auth that identifying failed """
+        self._authError = reason
+        self._authEvent.set()
+        log.warning('Authentication failed: %s', reason)
+
+    def _gotCap(self, msg):
+        """ CAP LS/ACK/NAK/NEW/DEL: asks for the capabilities we want """
+        if len(msg.params) < 3:
+            return
+        sub, caps = msg.params[1], msg.trailing.split()
+        if sub in ('LS', 'NEW'):
+            self._capsOffered.update(cap.partition('=')[0] for cap in caps)
+            if sub == 'LS' and len(msg.params) > 3 and msg.params[2] == '*':
+                # more LS lines are coming
+                return
+            want = [
+                    cap for cap in self.wantCaps
+                    if cap in self._capsOffered and cap not in self.caps
+                    ]
+            if self._capNegotiating and self.pswrd and self.sasl:
+                if 'sasl' in self._capsOffered:
+                    want.append('sasl')
+                else:
+                    self._authFailed('the server does not do SASL')
+            if want:
+                self._send('CAP REQ :%s' % ' '.join(want))
+            else:
+                self._capEnd()
+        elif sub == 'ACK':
+            for cap in caps:
+                if cap.startswith('-'):
+                    self.caps.discard(cap[1:])
+                else:
+                    self.caps.add(cap)
+            log.info('Capabilities: %s', Lazy(' '.join, sorted(self.caps)))
+            if 'sasl' in caps:
+                # CAP END once SASL is done
+                self._send('AUTHENTICATE PLAIN')
+            else:
+                self._capEnd()
+        elif sub == 'NAK':
+            if 'sasl' in caps:
+                self._authFailed('the server refused SASL')
+            self._capEnd()
+        elif sub == 'DEL':
+            self.caps.difference_update(caps)
+            self._capsOffered.difference_update(caps)
+
+    def _capEnd(self):
+        """ Ends capability negotiation (once, while registering) """
+        if self._capNegotiating:
+            self._capNegotiating = False
+            self._send('CAP END')
+
+    def _gotAuthenticate(self, msg):
+        """ The server is ready for our SASL PLAIN credentials """
+        if msg.params[0] != '+':
+            return
+        token = base64.b64encode(
+                ('%s\0%s\0%s' % (self.nick, self.nick, self.pswrd)).encode(
+                        'utf-8')
+                ).decode('ascii')
+        # sent in 400 byte pieces, a full last piece is followed by '+'
+        for i in range(0, len(token), 400):
+            self._send('AUTHENTICATE %s' % token[i:i + 400])
+        if len(token) % 400 == 0:
+            self._send('AUTHENTICATE +')
+
+    def _saslDone(self, msg):
+        """ 903: SASL worked, finish registering """
+        self._capEnd()
+        self._identified(msg)
+
+    def _saslFailed(self, msg):
+        """ 902/904/905/906/908: SASL did not work """
+        self._capEnd()
+        self._authFailed(msg.trailing)
+
+    def _gotBatch(self, msg):
+        """ BATCH +ref type / BATCH -ref: collects the lines in between """
+        ref = msg.params[0]
+        if ref[:1] == '+' and len(msg.params) > 1:
+            self._batches[ref[1:]] = (msg.params[1], msg.params[2:], [])
+        elif ref[:1] == '-':
+            batch = self._batches.pop(ref[1:], None)
+            if batch is not None:
+                self._endBatch(*batch)
+
+    def _endBatch(self, kind, params, msgs):
+        """
+        Applies a finished batch: netsplits and netjoins in one bulk
+        update, chathistory is dropped (no commands for old messages) and
+        the lines of anything else are handled one by one
+        """
+        if kind == 'netsplit':
+            nicks = [msg.nick for msg in msgs if msg.command == 'QUIT']
+            gone = self.members.quitMany(nicks)
+            self.accounts.forget(*nicks)
+            if self.store is not None:
+                for msg in msgs:
+                    if msg.command == 'QUIT':
+                        self._record('quit', None, msg, msg.trailing)
+            msgs = [msg for msg in msgs if msg.command != 'QUIT']
+            log.info('Netsplit %s: %d users quit', ' '.join(params), gone)
+        elif kind == 'netjoin':
+            join, joined = self.members.join, 0
+            for msg in msgs:
+                if msg.command == 'JOIN':
+                    join(msg.params[0], msg.nick, host=msg.userhost)
+                    self._joinAccount(msg)
+                    self._record('join', msg.params[0], msg)
+                    joined += 1
+            msgs = [msg for msg in msgs if msg.command != 'JOIN']
+            log.info('Netjoin %s: %d joins', ' '.join(params), joined)
+        elif kind == 'chathistory':
+            log.debug('Skipped %d lines of chat history', len(msgs))
+            return
+        for msg in msgs:
+            self._dispatch(msg)
+
+    def _gotAway(self, msg):
+        """ away-notify: AWAY :message, or just AWAY when back """
+        self.members.setAway(msg.nick, msg.trailing or None)
+
+    def _gotAccount(self, msg):
+        """ account-notify: ACCOUNT <account>, or ACCOUNT * on logout """
+        if msg.nick and msg.params:
+            account = msg.params[0]
+            self.accounts.setAccount(msg.nick, None if account == '*' else account)
+
+    def _joinAccount(self, msg):
+        """ extended-join: JOIN <channel> <account> :<realname> """
+        if len(msg.params) > 1 and 'extended-join' in self.caps:
+            account = msg.params[1]
+            self.accounts.setAccount(msg.nick, None if account == '*' else account)
+
+    def _joinedUser(self, msg):
         """ Fires when a user joins a channel """
-        logging.debug(match.group(0))
-        nick, channel = match.group(1), match.group(2)
-        if channel not in self.channels:
-            self.channels[channel] = Channel()
-        self.channels[channel].users[nick] = 0
-        logging.info('%s joined %s' % (nick, channel))
-
-    def _somebodyQuit(self, match):
+        nick, channel = msg.nick, msg.params[0]
+        self.members.join(channel, nick, host=msg.userhost)
+        self._joinAccount(msg)
+        self._record('join', channel, msg)
+        log.info('%s joined %s', nick, channel)
+
+    def _somebodyQuit(self, msg):
         """ Fires when a user quits """
-        logging.debug(match.group(0))
-        nick = match.group(1)
+        nick = msg.nick
         # if it is us quiting
         if nick == self.nick:
             self.disconnect()
         else:
-            for channel in self.channels:
-                if nick in self.channels[channel].users:
-                    del self.channels[channel].users[nick]
-                if nick in self.channels[channel].ops:
-                    del self.channels[channel].ops[nick]
-                if nick in self.channels[channel].voices:
-                    del self.channels[channel].voices[nick]
-        logging.info('%s quit!' % nick)
-
-    def _removeUser(self, match):
+            self.members.quit(nick)
+            self.accounts.forget(nick)
+            self._record('quit', None, msg, msg.trailing)
+        log.info('%s quit!', nick)
+
+    def _removeUser(self, msg):
         """ Removes a user from a channel """
-        logging.debug(match.group(0))
-        nick, channel = match.group(1), match.group(2)
-        if nick is self.nick:
-            del self.channels[channel]
+        nick, channel = msg.nick, msg.params[0]
+        reason = msg.trailing if len(msg.params) > 1 else None
+        self._record('part', channel, msg, reason)
+        if nick == self.nick:
+            self._saveChannel(channel)
+            self.members.drop(channel)
         else:
-            del self.channels[channel].users[nick]
-            if nick in self.channels[channel].ops:
-                del self.channels[channel].ops[nick]
-            if nick in self.channels[channel].voices:
-                del self.channels[channel].voices[nick]
-        logging.info('%s parted %s' % (nick, channel))
-        logging.debug(self.channels[channel].users)
-
-    def _updateTopic(self, match):
-        """ Update the topic for a channel """
-        logging.debug(match.group(0))
-        host, channel, topic = match.group(1), match.group(2), match.group(3)
-        if channel not in self.channels:
-            self.channels[channel] = Channel()
-        self.channels[channel].topic = topic
-        logging.info('[%s] TOPIC: %s' % (channel, self.channels[channel].topic))
-
-    def _updateNames(self, match):
-        """ Takes names from a 353 and populates the channels users """
-        logging.debug(match.group(0))
-        channel, names = match.group(1), match.group(2).split(' ')
-        if channel not in self.channels:
-            self.channels[channel] = Channel()
-        for name in names:
-            if name[0] == '@':
-                name = name[1:]
-                if name not in self.channels[channel].ops:
-                    self.channels[channel].ops.append(name)
-            if name[0] == '+':
-                name = name[1:]
-                if name not in self.channels[channel].voices:
-                    self.channels[channel].voices.append(name)
-            if name not in self.channels[channel].users:
-                self.channels[channel].users[name] = 0
-        logging.info('[%s] USERS: %s' % (
-                channel, str(self.channels[channel].users)
-                ))
-        logging.info('[%s] OPS: %s' % (
-                channel, str(self.channels[channel].ops)
-                ))
-        logging.info('[%s] VOICES: %s' % (
-                channel, str(self.channels[channel].voices)
-                ))
-
-    def _updateACC(self, match):
-        """ Updates an users ACC level """
-        logging.debug(match.group(0))
-        nick, acc = match.group(2), match.group(3)
-        if match.group(1) == self.nickserv:
-            for channel in self.channels:
-                self.channels[channel].users[nick] = acc
-        logging.info('ACC: %s [%d]' % (nick, acc))
-
-    def _modeSet(self, match):
-        """ Adds mode flags to a user in the CHANNELS dict """
-        logging.debug(match.group(0))
-        channel, mode, nick = match.group(1), match.group(2), match.group(3)
-        if 'o' in mode or 'O' in mode:
-            if nick not in self.channels[channel].ops:
-                self.channels[channel].ops.append(nick)
-        if 'v' in mode or 'V' in mode:
-            if nick not in self.channels[channel].voices:
-                self.channels[channel].voices.append(nick)
-        logging.debug('OPS: %s' % str(self.channels[channel].ops))
-        logging.debug('VOICES: %s' % str(self.channels[channel].voices))
-
-    def _modeUnset(self, match):
-        """ Removes mode flags from a user in the CHANNELS dict """
-        logging.debug(match.group(0))
-        channel, mode, nick = match.group(1), match.group(2), match.group(3)
-        if 'o' in mode or 'O' in mode:
-            try:
-                self.channels[channel].ops.remove(nick)
-            except Exception as e:
-                logging.exception(e)
-        if 'v' in mode or 'V' in mode:
-            try:
-                self.channels[channel].voices.remove(nick)
-            except Exception as e:
-                logging.exception(e)
-        logging.debug('OPS: %s' % str(self.channels[channel].ops))
-        logging.debug('VOICES: %s' % str(self.channels[channel].voices))
+            self.members.part(channel, nick)
+        log.info('%s parted %s', nick, channel)
+
+    def _kickedUser(self, msg):
+        """ Removes a kicked user from a channel """
+        channel, nick = msg.params[0], msg.params[1]
+        self._record('kick', channel, msg, nick)
+        if nick == self.nick:
+            self._saveChannel(channel)
+            self.members.drop(channel)
+        else:
+            self.members.part(channel, nick)
+        log.info('%s was kicked from %s by %s', nick, channel, msg.nick)
+
+    def _nickChanged(self, msg):
+        """ Follows a user (maybe us) to their new nick """
+        old, new = msg.nick, msg.params[0]
+        if old == self.nick:
+            self.nick = new
+            if self._broker is not None:
+                self._broker.setNick(new)
+        self.members.rename(old, new)
+        self.accounts.forget(old, new)
+        self._record('nick', None, msg, new)
+        log.info('%s is now known as %s', old, new)
+
+    def _updateTopic(self, msg):
+        """ Update the topic for a channel (332 or TOPIC) """
+        channel, topic = msg.params[-2], msg.trailing
+        self.members.channel(channel).topic = topic
+        if msg.command == 'TOPIC':
+            self._record('topic', channel, msg, topic)
+            self._saveChannel(channel)
+        log.info('[%s] TOPIC: %s', channel, self.channels[channel].topic)
+
+    def _record(self, kind, channel, msg, text=None):
+        """ Hands an event to the store (if there is one) """
+        if self.store is not None:
+            self.store.add(
+                    self.network, kind, channel, msg.nick, msg.userhost, text
+                    )
+
+    def _saveChannel(self, channel):
+        """ Hands the state of a channel to the store (if there is one) """
+        if self.store is not None and channel in self.channels:
+            self.store.saveChannel(
+                    self.network, self.channels[channel], self.members.users
+                    )
+
+    @property
+    def network(self):
+        """ The name events are stored under """
+        return self.hosts[0]
+
+    def _updateNames(self, msg):
+        """ Collects the names (and hosts) from a 353 until the 366 """
+        channel = msg.params[-2]
+        names = self._names.get(channel)
+        if names is None:
+            names = self._names[channel] = ({}, {})
+        parseNames(msg.trailing, self._prefixes, *names)
+
+    def _endOfNames(self, msg):
+        """ 366: swap the collected names in as the channels users """
+        channel = msg.params[1]
+        names = self._names.pop(channel, None)
+        if names is None:
+            return
+        members = self.members.sync(channel, *names).members
+        self._saveChannel(channel)
+        log.info(
+                '[%s] %d users, %s ops, %s voices', channel, len(members),
+                Lazy(_countFlags, members, OP), Lazy(_countFlags, members, VOICE)
+                )
+
+    def _updateACC(self, msg):
+        """
+        '<nick> ACC <level>' (or '<nick> -> <account> ACC <level>' when
+        the nick is logged in to another account): caches it and wakes
+        the lookups
+        """
+        words = msg.trailing.split()
+        if 'ACC' not in words[1:]:
+            return
+        level = words.index('ACC', 1) + 1
+        if level >= len(words) or not words[level].isdigit():
+            return
+        nick, acc = words[0], int(words[level])
+        self.members.setAcc(nick, acc)
+        self.accounts.setAcc(nick, acc)
+        log.info('ACC: %s [%d]', nick, acc)
+
+    def _gotMode(self, msg):
+        """ Walks a MODE change and applies the user modes we track """
+        channel = msg.params[0]
+        if channel not in self.channels or len(msg.params) < 3:
+            return
+        args = iter(msg.params[2:])
+        adding = True
+        for mode in msg.params[1]:
+            if mode in '+-':
+                adding = mode == '+'
+                continue
+            if mode not in self._paramModes and \
+                    not (adding and mode in self._setParamModes):
+                continue
+            nick = next(args, None)
+            if nick is None:
+                break
+            if adding:
+                self._modeSet(channel, mode, nick)
+            else:
+                self._modeUnset(channel, mode, nick)
+
+    def _modeSet(self, channel, mode, nick):
+        """ Adds a mode flag to a user in the channel """
+        if mode in MODEFLAGS:
+            self.members.setMode(channel, nick, MODEFLAGS[mode], True)
+
+    def _modeUnset(self, channel, mode, nick):
+        """ Removes a mode flag from a user in the channel """
+        if mode in MODEFLAGS:
+            self.members.setMode(channel, nick, MODEFLAGS[mode], False)
 #-------------------------------------------------------------------------------
     def sendMessage(self, target, message):
         """ Send a message """
@@ -243,9 +684,28 @@ class IRCServer(object):
         self._send("NOTICE %s :%s" % (target, message))
 
     def checkACC(self, nick):
-        """ Check the acc level of a nick """
+        """
+        Check the acc level of a nick, returns a concurrent.futures.Future
+        for it (see accounts.AccountCache, NickServ is only asked if the
+        level isn't cached or being asked for already)
+        """
+        return self.accounts.lookup(nick, self._askACC)
+
+    def _askACC(self, nick):
+        """ Asks NickServ for the acc level of a nick """
         self._send("NICKSERV ACC %s" % nick)
 
+    def waitACC(self, nick, timeout=10):
+        """
+        The acc level of a nick, None if NickServ didn't answer within
+        <timeout> seconds (blocks: for command functions, not server
+        handlers)
+        """
+        try:
+            return self.checkACC(nick).result(timeout)
+        except (FutureTimeout, CancelledError):
+            return None
+
     def joinChannel(self, channel):
         """ Join a channel """
         self._send("JOIN %s" % channel)
@@ -259,7 +719,7 @@ class IRCServer(object):
         self.nick = nick
         self.compileRe()
         self._send("NICK %s" % nick)
-        logging.info('Nick changed!')
+        log.info('Nick changed!')
 
     def setChannelTopic(self, channel, topic):
         """ Change channel topic """
@@ -273,231 +733,573 @@ class IRCServer(object):
         """ Send quit message """
         self._send("QUIT :%s" % message)
 
-#-------------------------------------------------------------------------------
-    def loadCommands(self, commands):
-        """
-        Loads a dict as self.commands and compiles regex (overwrites all)
-        """
-        logging.info('Loading commands')
-        self.commands = commands
-        self._pool.map(self._compileCommandRe, self.commands)
-
-    def addCommand(self, name, regex, func):
-        """
-        Add a command to the self.commands dict
-        (overwrites commands with the same <name>)
-        """
-        self.commands[name] = CommandHandle(regex, func)
-        self._compileCommandRe(name)
-        logging.info('Command: %s added!' % name)
-
-    def removeCommand(self, name):
-        """ Remove <name> command from the self.commands dict """
-        del self.commands[name]
-        logging.info('Command: %s removed!' % name)
-
 #-------------------------------------------------------------------------------
     def _compileServerRe(self, command):
         """ Compiles single server regex by command name """
-        self._serverRe[command].cregex = []
-        logging.debug(self._serverRe[command].regex)
-        for item in self._serverRe[command].regex:
-            self._serverRe[command].cregex.append(re.compile(item))
-
-    def _compileCommandRe(self, command):
-        """ Compiles single command regex by command name """
-        self.commands[command].cregex = []
-        logging.debug(self.commands[command].regex)
-        for item in self.commands[command].regex:
-            self.commands[command].cregex.append(re.compile(item))
+        handle = self._serverRe[command]
+        log.debug(handle.regex)
+        handle.cregex = [compilePattern(item) for item in handle.regex]
 
     def compileRe(self):
-        """ Uses the thread pool to compile all the commands regex """
-        logging.info('Compiling regex!')
-        self._pool.map(self._compileServerRe, self._serverRe)
-        self._pool.map(self._compileCommandRe, self.commands)
+        """ Compiles all the server and commands regex """
+        log.info('Compiling regex!')
+        for name in self._serverRe:
+            self._compileServerRe(name)
+        for name in self.commands:
+            self._compileCommandRe(name)
+        self._buildIndex()
+
+    def joinChannels(self, channels):
+        """ Join many channels with as few (comma joined) JOINs as we can """
+        batch, size = [], len('JOIN ')
+        for chan in channels:
+            if batch and size + len(chan) + 1 > MAXLINE:
+                self._send('JOIN %s' % ','.join(batch))
+                batch, size = [], len('JOIN ')
+            batch.append(chan)
+            size += len(chan) + 1
+        if batch:
+            self._send('JOIN %s' % ','.join(batch))
 
     def _autoJoin(self):
-        """ Join all the channels in self.autojoin """
-        for chan in self.joinChans:
-            logging.info('Auto joining: %s' % chan)
-            self.joinChannel(chan)
+        """ Join self.joinChans and the channels we were in before """
+        channels = list(self.joinChans)
+        channels += [chan for chan in self._rejoin if chan not in channels]
+        self._rejoin = []
+        if channels:
+            log.info('Auto joining: %s', Lazy(', '.join, channels))
+            self.joinChannels(channels)
 #-------------------------------------------------------------------------------
     def _sniffLine(self, line):
         """
-        Searches the line for anything relevent
-        executes the function for the match
+        Tokenizes the line and executes the handler for its command,
+        falls back to the custom server regex if there is none
         """
-        match = False
+        msg = parseLine(line)
+        if msg is None:
+            return
+        # the channel is the first param, or one of the next for numerics
+        if self._traced and (
+                TRACEALL in self._traced or
+                not self._traced.isdisjoint(msg.params[:3])
+                ):
+            trace.debug('%s < %s', self.host, line)
+        if msg.tags and self._batches:
+            batch = self._batches.get(msg.tags.get('batch'))
+            if batch is not None and msg.command != 'BATCH':
+                batch[2].append(msg)
+                return True
+        return self._dispatch(msg)
+
+    def _dispatch(self, msg):
+        """ Runs the handler (or custom regex) for a tokenized line """
+        timed = self.metrics.enabled
+        handler = self._serverCmds.get(msg.command)
+        if handler is not None:
+            if timed:
+                start = time.perf_counter()
+                handler(msg)
+                self.metrics.observe(
+                        'server', msg.command, time.perf_counter() - start
+                        )
+            else:
+                handler(msg)
+            return True
+        line = msg.raw
         for name in self._serverRe:
             for item in self._serverRe[name].cregex:
                 match = item.search(line)
                 if match:
-                    self._serverRe[name].function(match)
+                    if timed:
+                        start = time.perf_counter()
+                        self._serverRe[name].function(match)
+                        self.metrics.observe(
+                                'regex', name, time.perf_counter() - start
+                                )
+                    else:
+                        self._serverRe[name].function(match)
                     return True
 
-    def _sniffMessage(self, match):
+    def _sniffMessage(self, msg):
         """
         Search PRIVMESG/NOTICE for a command
         executes the function for the match
         """
+        if not msg.userhost or len(msg.params) < 2:
+            return
         nick, host, chan, message = \
-                match.group(1), match.group(2), match.group(3), match.group(4)
-        cmatch = False
-        logging.info('[%s] %s: %s' % (chan, nick, message))
-        for name in self.commands:
-            for regex in self.commands[name].cregex:
-                cmatch = regex.search(message)
-                if cmatch:
-                    self.commands[name].function(chan, nick, host, cmatch)
+                msg.nick, msg.userhost, msg.params[0], msg.trailing
+        log.info('[%s] %s: %s', chan, nick, message)
+        self._record(msg.command.lower(), chan, msg, message)
+        if self._broker is not None:
+            self._broker.publish(self._replyTarget(chan, nick), msg.raw)
+            return True
+        if self.metrics.enabled:
+            start = time.perf_counter()
+            found = self._commandIndex.match(message)
+            self.metrics.observe(
+                    'match', found[0] if found else '-',
+                    time.perf_counter() - start
+                    )
+        else:
+            found = self._commandIndex.match(message)
+        if found:
+            name, handle, cmatch = found
+            if not handle.allow(chan, nick, host):
+                self.metrics.count('limited')
+                log.debug('Command %s from %s is over its limit', name, nick)
+                return True
+            if handle.cache is not None:
+                result = handle.cache.get((name, cmatch.groups()))
+                if result is not None:
+                    self._sendResult(self._replyTarget(chan, nick), result)
                     return True
+            if handle.executor == 'process':
+                self._offloadCommand(name, handle, chan, nick, host, cmatch)
+            else:
+                self._runCommand(name, handle, chan, nick, host, cmatch)
+            return True
+
+    def _runCommand(self, name, handle, chan, nick, host, match):
+        """ Queues the function of a matched command on the workers """
+        self._workers.submit(
+                self._orderKey(chan, nick), self._commandFunction(name, handle),
+                chan, nick, host, match
+                )
+
+    def _commandFunction(self, name, handle):
+        """
+        The function to run for a command (timed if metrics are on, its
+        result sent and cached if the command has a cache)
+        """
+        function = handle.function
+        if handle.cache is not None:
+            function = self._cachedFunction(name, handle, function)
+        if self.metrics.enabled:
+            return self.metrics.timed(name, function)
+        return function
+
+    def _cachedFunction(self, name, handle, function):
+        """ Wraps <function> to send and cache what it returns """
+        def store(chan, nick, match, result):
+            if result is not None:
+                handle.cache.put((name, match.groups()), result)
+                self._sendResult(self._replyTarget(chan, nick), result)
+            return result
+        if isCoroutineFunction(function):
+            async def cached(chan, nick, host, match):
+                result = await function(chan, nick, host, match)
+                return store(chan, nick, match, result)
+        else:
+            def cached(chan, nick, host, match):
+                result = function(chan, nick, host, match)
+                return store(chan, nick, match, result)
+        return cached
+
+    def _offloadCommand(self, name, handle, chan, nick, host, match):
+        """
+        Runs the function of a matched command in a worker process, what
+        it returns (a string or a list of them) is sent to the channel
+        (or the nick in a private chat)
+        """
+        offload = self._getOffload()
+        target = self._replyTarget(chan, nick)
+        if handle.cache is not None:
+            key = (name, match.groups())
+            def reply(result):
+                handle.cache.put(key, result)
+                self._sendResult(target, result)
+        else:
+            reply = lambda result: self._sendResult(target, result)
+        offload.submit(
+                name, handle, (chan, nick, host, Match(match)), reply
+                )
+
+    def _sendResult(self, target, result):
+        """ Sends what an offloaded (or cached) command returned """
+        if isinstance(result, str):
+            result = result.splitlines()
+        for line in result:
+            if line:
+                self.sendMessage(target, line)
+
+    def _orderKey(self, chan, nick):
+        """ Commands with the same key run one at a time, in order """
+        return self._replyTarget(chan, nick)
+
+    def _replyTarget(self, chan, nick):
+        """ Where replies go: the channel, or the nick in a private chat """
+        if chan == self.nick:
+            return nick
+        return chan
 #-------------------------------------------------------------------------------
     def _identifyNick(self, pswrd):
         """ Identify bot nickname with nickserv """
         self._send("NICKSERV IDENTIFY %s" % (pswrd))
 
-    def auth(self, nick):
-        """ Login to the IRC server and identify with nickserv"""
-        logging.info('Authenticating bot with server...')
+    def _register(self, nick):
+        """ Sends the registration (asking for SASL first if we use it) """
+        log.info('Authenticating bot with server...')
+        self._welcomed.clear()
+        self._authEvent.clear()
+        self._authError = None
+        # registration waits for CAP END if the server does CAP
+        self._capNegotiating = True
+        self._send('CAP LS 302')
         self._send(
             "USER %s %s %s :This bot is a result of open-source development." %\
                     (nick, nick, nick)
             )
         self._send("NICK %s" % nick)
-        if self.pswrd:
-            logging.debug('We have a nick password!')
-            self._identifyNick(self.pswrd)
-            logging.info('Waiting on Nickserv...')
-            count = 0
-            while not self._authed:
-                time.sleep(5)
-                count += 1
-                if count > 5:
-                    raise RuntimeError('Failed to auth with Nickserv')
-        else:
+
+    def _checkAuth(self, identified):
+        """ Raises if identifying did not work out """
+        if not identified:
+            raise RuntimeError('Timed out waiting to identify')
+        if self._authError is not None:
+            raise RuntimeError('Failed to identify: %s' % self._authError)
+
+    def _authWait(self, event):
+        """
+        Waits up to authtimeout for <event>, raises ConnectionError right
+        away if the connection is (or goes) away meanwhile
+        """
+        if self._connected:
+            event.wait(self.authtimeout)
+        if not self._connected:
+            raise ConnectionError('Lost the connection while authenticating')
+        return event.is_set()
+
+    def auth(self, nick):
+        """
+        Login to the IRC server and identify (SASL or nickserv), returns
+        once registered and identified
+        """
+        self._register(nick)
+        if not self._authWait(self._welcomed):
+            raise RuntimeError('The server did not welcome us')
+        if not self.pswrd:
             self._authed = True
+            return
+        if not self.sasl:
+            log.info('Waiting on Nickserv...')
+            self._identifyNick(self.pswrd)
+        self._checkAuth(self._authWait(self._authEvent))
 
     def _send(self, message):
-        """ Sends a message to IRC server """
-        logging.debug("> %s" % message)
-        message = "%s\r\n" % message
-        try:
-            self._sock.send(message.encode("utf-8"))
-        except (socket.timeout, socket.error, ssl.SSLError) as e:
-            logging.warning("Socket Error: Could not send!")
-            logging.exception(e)
+        """ Queues a message for the IRC server """
+        if self._traced:
+            target = message.split(' ', 2)[1:2]
+            if TRACEALL in self._traced or (target and target[0] in self._traced):
+                trace.debug('%s > %s', self.host, message)
+        self._sendq.put(message)
+
+    def _write(self, data):
+        """ Writes a batch of lines to the socket (writer thread) """
+        sock = self._sock
+        if sock is None:
+            raise socket.error('Not connected')
+        if self.metrics.enabled:
+            start = time.perf_counter()
+            sock.sendall(data)
+            self.metrics.observe('write', 'socket', time.perf_counter() - start)
+        else:
+            sock.sendall(data)
+
+    def _sendError(self, e):
+        """ The writer could not send """
+        if isinstance(e, (socket.timeout, socket.error, ssl.SSLError)):
+            log.warning("Socket Error: Could not send!")
+            log.exception(e)
             self._connected = False
-        except Exception as e:
-            logging.exception(e)
+        else:
+            log.exception(e)
             self._connected, self._running = False, False
+        self._lost()
+
+    def _lost(self):
+        """ The connection is gone: wakes run() and a waiting auth() up """
+        self._dropped.set()
+        self._welcomed.set()
+        self._authEvent.set()
+
+    def sendStats(self):
+        """ Outbound queue depth, lines sent and wait times """
+        return self._sendq.stats()
+
+    def traceChannel(self, channel=TRACEALL, on=True):
+        """
+        Logs every line to/from <channel> (all lines for '*') to the
+        'stirbot.trace' logger at DEBUG
+        """
+        if on:
+            self._traced.add(channel)
+            if trace.level == logging.NOTSET:
+                trace.setLevel(logging.DEBUG)
+        else:
+            self._traced.discard(channel)
+
+    def stats(self):
+        """
+        Snapshot of the counters, handler latencies (see metrics.Metrics),
+        the send queue and the workers
+        """
+        stats = self.metrics.snapshot()
+        counters = stats['counters']
+        counters['reconnects'] = max(0, counters.get('connects', 0) - 1)
+        stats['sendq'] = self._sendq.stats()
+        stats['workers'] = self._workers.stats()
+        if self._offload is not None:
+            stats['offload'] = self._offload.stats()
+        commands = dict(
+                (name, handle.stats()) for name, handle in self.commands.items()
+                if handle.limits or handle.cache is not None
+                )
+        if commands:
+            stats['commands'] = commands
+        stats['accounts'] = self.accounts.stats()
+        if self.store is not None:
+            stats['store'] = self.store.stats()
+        if self._broker is not None:
+            stats['broker'] = self._broker.stats()
+        return stats
+
+    def startBroker(
+                self, workers=4, setup=None, path=None, partitions=None,
+                **options
+                ):
+        """
+        Broker mode: PRIVMSG/NOTICE lines are handed to worker processes
+        (broker.BrokerWorker) over a Unix socket instead of running the
+        commands here, partitioned by channel into <partitions> (default
+        <workers>) that each take one worker. With <setup> (a function
+        adding the commands to a worker) <workers> processes are started
+        (<options> like threads or queuesize go to their BrokerWorker),
+        other workers can connect to broker.path themselves. This process
+        keeps the connection, the channel state and the flood control.
+        """
+        if self._broker is None:
+            from .broker import Broker
+            self._broker = Broker(self, path, partitions or workers)
+            if setup is not None:
+                self._broker.spawn(workers, setup, **options)
+        return self._broker
+
+    def stopBroker(self):
+        """ Stops the workers, commands run here again """
+        broker, self._broker = self._broker, None
+        if broker is not None:
+            broker.close()
+
+    def enableMetrics(self, on=True):
+        """ Turn handler timing on/off (counters are always kept) """
+        self.metrics.enabled = on
+
+    def serveMetrics(self, port=9105, host='127.0.0.1'):
+        """
+        Serves stats() as Prometheus text on http://<host>:<port>/metrics
+        (turns the metrics on)
+        """
+        self.enableMetrics()
+        if self._metricsServer is None:
+            self._metricsServer = MetricsServer(
+                    lambda: prometheus(self.stats(), self.metrics), host, port
+                    )
+        return self._metricsServer
 
     def _listen(self):
         """ This should be running in a thread """
-        logging.info('Listening...')
+        log.info('Listening...')
+        sock = self._sock
         while self._connected:
             try:
-                data = self._sock.recv(4096)
+                size = self._lineBuffer.readFrom(sock)
             except (socket.timeout, ssl.SSLError) as e:
                 if 'timed out' in e.args[0]:
                     continue
                 else:
-                    logging.exception(e)
+                    log.exception(e)
                     self._connected = False
                     continue
             except socket.error as e:
-                logging.exception(e)
+                if self._connected:
+                    log.exception(e)
                 self._connected = False
                 continue
             else:
-                if len(data) == 0:
-                    logging.warn('Listen socket closed!')
+                if size == 0:
+                    log.warning('Listen socket closed!')
                     self._connected = False
                     continue
-                try:
-                    data = data.strip(b'\r\n').decode("utf-8")
-                    self._listenPool.map(self._sniffLine, data.splitlines())
-                except Exception as e:
-                    logging.exception(e)
-                    continue
-        self._listenPool.join()
-        logging.info('No longer listening...')
+                # server lines are handled right here, only command
+                # functions are handed to the workers
+                self._sniffLines(self._lineBuffer.lines())
+        self._lost()
+        log.info('No longer listening...')
 
-    def connect(self):
-        """Connect the socket to the server and listen"""
-        while not self._connected:
-            logging.info("Connecting to %s:%s" % (self.host, str(self.port)))
-            self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self._sock.settimeout(2)
-            if not self._sock.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE):
-                logging.debug('Keeping socket alive')
-                self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    def _sniffLines(self, lines):
+        """ Handles the lines of one read, timing it if metrics are on """
+        if self.metrics.enabled:
+            start = time.perf_counter()
+            self.metrics.count('lines', len(lines))
+        for line in lines:
+            try:
+                self._sniffLine(line)
+            except Exception as e:
+                log.exception(e)
+        if self.metrics.enabled:
+            self.metrics.observe('reader', 'lag', time.perf_counter() - start)
+
+    def _candidates(self):
+        """ Endless (host, port) cycle, the last one that worked first """
+        hosts = [self.host] + [host for host in self.hosts if host != self.host]
+        ports = SSLPORTS if self.ssl else NONSSLPORTS
+        return candidates(hosts, self.port, ports)
+
+    def _open(self, host, port):
+        """ Opens a (maybe ssl) socket to host:port """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.settimeout(2)
+        if not sock.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE):
+            log.debug('Keeping socket alive')
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        try:
             if self.ssl:
-                self._sock = ssl.wrap_socket(self._sock)
+                sock = ssl.create_default_context().wrap_socket(
+                        sock, server_hostname=host
+                        )
+            sock.connect((host, port))
+        except:
+            sock.close()
+            raise
+        return sock
+
+    def connect(self):
+        """ Connect the socket to the first server that answers """
+        self._lineBuffer.clear()
+        for host, port in self._candidates():
+            if self._stopped.is_set():
+                return
+            log.info("Connecting to %s:%s", host, port)
             try:
-                self._sock.connect((self.host, self.port))
+                self._sock = self._open(host, port)
             except (socket.timeout, socket.error, ssl.SSLError) as e:
-                logging.exception(e)
-                time.sleep(1.0)
+                log.warning('Could not connect to %s:%s: %r', host, port, e)
+                self.metrics.count('connect_errors')
+                self._stopped.wait(self._backoff.next())
                 continue
             except Exception as e:
-                logging.exception(e)
-                self._connected, self._running = False, False
-            else:
-                logging.info("Connected!")
-                self._connected = True
+                log.exception(e)
+                self._running = False
+                return
+            log.info("Connected!")
+            self.host, self.port = host, port
+            self._connected = True
+            self.metrics.count('connects')
+            self._sendq.start()
+            return
+
+    def _close(self):
+        """ Drops the connection and the state that came with it """
+        with self._closeLock:
+            sock, self._sock = self._sock, None
+            self._connected, self._authed = False, False
+            if sock is not None:
+                self._resetState()
+            self._sendq.clear()
+            self._lost()
+        if sock is not None:
+            self.metrics.count('disconnects')
+            try:
+                # close() alone does not wake the listener's recv up
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            try:
+                sock.close()
+            except Exception as e:
+                log.exception(e)
+        listener = self._listenThread
+        if listener is not None and listener is not threading.current_thread():
+            listener.join()
+        log.debug('Socket closed, listener joined')
 
     def disconnect(self):
-        """ Disconnect from the server """
-        logging.info('Disconnecting...')
-        self._connected, self._running, self._authed = False, False, False
-        self.servHost, self.channels = None, {}
-        try:
-            self._pool.close()
-            self._listenPool.close()
-        except Exception as e:
-            logging.exception(e)
-        logging.debug('Pool closed')
-        try:
-            self._pool.join()
-        except Exception as e:
-            logging.exception(e)
-        logging.debug('Pool joined')
-        self._pool = Pool(self.threads)
-        logging.debug('Pool cleared')
-        try:
-            self._listenThread.join()
-        except Exception as e:
-            logging.exception(e)
-        logging.debug('Listen Thread joined(?)')
-        try:
-            self._sock.close()
-        except Exception as e:
-            logging.exception(e)
-        logging.debug('Socket closed(?)')
-        logging.info('Disconnected!')
+        """ Disconnect from the server (and stop reconnecting) """
+        log.info('Disconnecting...')
+        self._running = False
+        self._stopped.set()
+        self._close()
+        # the writer thread is started again by connect()
+        self._sendq.stop()
+        self._shutdown()
+        log.info('Disconnected!')
+
+    def _shutdown(self):
+        """ Stops what runs beside the connection (after disconnect()) """
+        self._stopWorkers()
+        if self._metricsServer is not None:
+            self._metricsServer.close()
+            self._metricsServer = None
+        self._stopOffload()
+        self.stopBroker()
 
     def __call__(self):
-        """ Starts the connection to the server """
+        """
+        Starts the connection to the server and keeps it up until
+        disconnect() (blocks), regex and workers are kept across reconnects
+        """
         self._running = True
-        while self._running:
-            self.compileRe()
-            self._listenThread = Process(name='Listener', target=self._listen)
-            self._listenThread.daemon = True
-            try:
+        self._stopped.clear()
+        self.compileRe()
+        try:
+            while self._running:
                 self.connect()
+                if not self._connected:
+                    break
+                self._dropped.clear()
+                self._listenThread = threading.Thread(
+                        name='Listener', target=self._listen
+                        )
+                self._listenThread.daemon = True
                 self._listenThread.start()
-                self.auth(self.nick)
-            except:
-                self.disconnect()
-                continue
-            self._autoJoin()
-            while self._connected:
                 try:
-                    time.sleep(0.5)
-                except:
-                    self.disconnect()
+                    self.auth(self.nick)
+                except ConnectionError as e:
+                    log.warning('%s', e)
+                except Exception as e:
+                    log.exception(e)
+                else:
+                    self._autoJoin()
+                    self._dropped.wait()
+                self._close()
+                if self._running:
+                    delay = self._backoff.next()
+                    log.info('Reconnecting in %.1fs', delay)
+                    self._stopped.wait(delay)
+        except KeyboardInterrupt:
+            self.disconnect()
+
+# imported on first use: asyncio and multiprocessing are slow to import
+# and a bot that uses neither shouldn't pay for them
+LAZY = {
+        'AsyncIRCServer': 'aio',
+        'BotManager': 'manager',
+        'Broker': 'broker',
+        'BrokerWorker': 'broker'
+        }
+
+
+def __getattr__(name):
+    """ stirbot.AsyncIRCServer, BotManager, Broker and BrokerWorker """
+    if name not in LAZY:
+        raise AttributeError("module 'stirbot' has no attribute %r" % name)
+    module = __import__('stirbot.%s' % LAZY[name], fromlist=[name])
+    return getattr(module, name)
+
 
 if __name__ == "__main__":
+    from logging.handlers import RotatingFileHandler
     logging.basicConfig(
             format='[%(asctime)s] %(message)s',
             datefmt="%m-%d %H:%M:%S",
@@ -507,7 +1309,10 @@ if __name__ == "__main__":
     logger.addHandler(
             RotatingFileHandler('ircbot.log', maxBytes=10**9, backupCount=5)
             )
+    # the console and log file are written from a background thread
+    queueLogging(logger)
     bot = IRCServer('s10tb0t', ssl=True)
+    bot.traceChannel()
     def shutit(channel, nick, host, match):
         bot.sendMessage(channel, '%s asked me to quit! See ya!' % nick)
         bot._running = False
@@ -0,0 +1,138 @@
+""" NickServ ACC levels and services accounts, cached per nick """
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+class AccountCache(object):
+    """
+    ACC levels (and services accounts, from account-notify/extended-join)
+    by nick, kept for <ttl> seconds for at most <maxsize> nicks (least
+    recently used dropped first). Nicks are forgotten when they change
+    nick or quit.
+
+    lookup() returns a concurrent.futures.Future for the ACC level: done
+    already on a hit, else shared by everyone asking about the same nick
+    until NickServ answers (asked again after <retry> seconds without
+    an answer). Don't cancel it, other callers may wait on it too.
+    """
+    def __init__(self, ttl=300, maxsize=4096, retry=30):
+        self.ttl, self.maxsize, self.retry = ttl, maxsize, retry
+        # nick -> [acc, account, expires]
+        self._items = OrderedDict()
+        # nick -> [Future, sent]
+        self._pending = {}
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.coalesced = self.requests = 0
+
+    def _entry(self, key):
+        """ The cache entry for <key>, made if needed (lock held) """
+        item = self._items.get(key)
+        if item is None:
+            item = self._items[key] = [None, None, 0]
+            if len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+        else:
+            self._items.move_to_end(key)
+        return item
+
+    def lookup(self, nick, ask):
+        """
+        A Future for the ACC level of <nick>, <ask>(nick) is called when
+        NickServ has to be asked
+        """
+        key, now = nick.lower(), time.monotonic()
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None and item[0] is not None and item[2] >= now:
+                self._items.move_to_end(key)
+                self.hits += 1
+                future = Future()
+                future.set_result(item[0])
+                return future
+            pending = self._pending.get(key)
+            if pending is not None and now - pending[1] < self.retry:
+                self.coalesced += 1
+                return pending[0]
+            self.misses += 1
+            self.requests += 1
+            if pending is None:
+                self._prune(now)
+                pending = self._pending[key] = [Future(), now]
+            else:
+                pending[1] = now
+        ask(nick)
+        return pending[0]
+
+    def _prune(self, now):
+        """ Gives up on lookups that never got an answer (lock held) """
+        if len(self._pending) < self.maxsize:
+            return
+        for key, pending in list(self._pending.items()):
+            if now - pending[1] >= self.retry:
+                del self._pending[key]
+                pending[0].cancel()
+
+    def get(self, nick):
+        """ The cached ACC level of <nick>, or None """
+        with self._lock:
+            item = self._items.get(nick.lower())
+            if item is None or item[2] < time.monotonic():
+                return None
+            return item[0]
+
+    def account(self, nick):
+        """ The services account <nick> is logged in to, or None """
+        with self._lock:
+            item = self._items.get(nick.lower())
+            return item[1] if item is not None else None
+
+    def setAcc(self, nick, acc):
+        """ NickServ answered, wakes whoever waits on <nick> """
+        key = nick.lower()
+        with self._lock:
+            item = self._entry(key)
+            item[0], item[2] = acc, time.monotonic() + self.ttl
+            pending = self._pending.pop(key, None)
+        if pending is not None and not pending[0].done():
+            pending[0].set_result(acc)
+
+    def setAccount(self, nick, account):
+        """
+        account-notify/extended-join: <nick> is logged in to <account>
+        (None: logged out), the ACC level is known if that is its own
+        account, else NickServ is asked again next time
+        """
+        if account is not None and account.lower() == nick.lower():
+            self.setAcc(nick, 3)
+        with self._lock:
+            item = self._entry(nick.lower())
+            item[1] = account
+            if account is None or account.lower() != nick.lower():
+                item[0] = None
+
+    def forget(self, *nicks):
+        """ <nicks> quit or changed nick """
+        with self._lock:
+            for nick in nicks:
+                self._items.pop(nick.lower(), None)
+
+    def clear(self):
+        """ Forgets everything, lookups in flight are cancelled """
+        with self._lock:
+            self._items.clear()
+            pending, self._pending = self._pending, {}
+        for future, sent in pending.values():
+            future.cancel()
+
+    def stats(self):
+        with self._lock:
+            return {
+                    'size': len(self._items),
+                    'pending': len(self._pending),
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'coalesced': self.coalesced,
+                    'requests': self.requests
+                    }
@@ -0,0 +1,282 @@
+""" asyncio engine for IRCServer """
+import asyncio
+import ssl
+import threading
+import time
+
+from . import IRCServer
+from .log import log
+from .metrics import isCoroutineFunction
+
+
+class AsyncIRCServer(IRCServer):
+    """
+    Manages an Irc server connection on an asyncio event loop
+
+    Same api as IRCServer (sendMessage, joinChannel, addCommand...) but
+    the socket is read by the loop instead of a listener thread, server
+    lines are handled inline and command functions are either scheduled
+    as tasks (coroutine functions) or run in a small bounded SerialPool
+    (plain functions). Several bots can share one loop and one <pool>:
+
+        pool = stirbot.workers.SerialPool(4)
+        bots = [AsyncIRCServer('stirbot', host, pool=pool) for host in hosts]
+        asyncio.run(asyncio.wait([bot.run() for bot in bots]))
+    """
+    def __init__(
+                self, nick, host="chat.freenode.net", pool=None, threads=4,
+                **kwargs
+                ):
+        self._sharedPool = pool
+        IRCServer.__init__(self, nick, host=host, threads=threads, **kwargs)
+        self._loop = self._loopThread = None
+        self._reader = self._writer = None
+        # asyncio events are made on the loop by run()
+        self._welcomed = self._authEvent = self._sendEvent = None
+        self._stopped = None
+        self._tasks = set()
+        self._sendq.notify = self._wakeWriter
+
+    def _makeWorkers(self):
+        """ The bounded pool for plain command functions (maybe shared) """
+        if self._sharedPool is not None:
+            return self._sharedPool
+        return IRCServer._makeWorkers(self)
+
+    def _stopWorkers(self):
+        """ A shared pool belongs to whoever made it """
+        if self._sharedPool is None:
+            IRCServer._stopWorkers(self)
+#-------------------------------------------------------------------------------
+    def _runCommand(self, name, handle, chan, nick, host, match):
+        """ Schedules coroutines on the loop, plain functions in the pool """
+        func = self._commandFunction(name, handle)
+        if isCoroutineFunction(func):
+            task = self._loop.create_task(func(chan, nick, host, match))
+            self._tasks.add(task)
+            task.add_done_callback(self._taskDone)
+        else:
+            self._workers.submit(
+                    self._orderKey(chan, nick), func, chan, nick, host, match
+                    )
+
+    def _taskDone(self, task):
+        """ Forgets a finished command task, logging what it raised """
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            self._handlerError(task.exception())
+
+    def _handlerError(self, e):
+        """ Logs an exception raised by a command function """
+        log.error('Command failed: %r', e)
+#-------------------------------------------------------------------------------
+    def _wakeWriter(self):
+        """ Something was queued (maybe from a pool thread) """
+        if self._sendEvent is None:
+            return
+        if threading.get_ident() == self._loopThread:
+            self._sendEvent.set()
+        else:
+            self._loop.call_soon_threadsafe(self._sendEvent.set)
+
+    def _write(self, data):
+        """ Writes a batch to the stream (on the loop) """
+        if self.metrics.enabled:
+            start = time.perf_counter()
+            self._writer.write(data)
+            self.metrics.observe('write', 'socket', time.perf_counter() - start)
+        else:
+            self._writer.write(data)
+
+    def _sendError(self, e):
+        """ The stream could not be written to """
+        log.warning("Socket Error: Could not send!")
+        log.exception(e)
+        self._connected = False
+        self._lost()
+
+    def _lost(self):
+        """ The connection is gone: wakes a waiting auth() up (on the loop) """
+        if self._welcomed is not None:
+            self._welcomed.set()
+            self._authEvent.set()
+
+    async def _drain(self):
+        """ Writes the send queue out as fast as flood control allows """
+        while self._connected:
+            self._sendEvent.clear()
+            batch, delay = self._sendq.take()
+            if batch:
+                self._sendq.flush(batch)
+                continue
+            try:
+                await asyncio.wait_for(self._sendEvent.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _wait(self, event, timeout):
+        """ Waits up to <timeout> for <event>, returns if it was set """
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return event.is_set()
+
+    async def waitACC(self, nick, timeout=10):
+        """
+        The acc level of a nick, None if NickServ didn't answer within
+        <timeout> seconds
+        """
+        # shielded: a timeout must not cancel the lookup others share
+        future = asyncio.wrap_future(self.checkACC(nick))
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            return None
+        except asyncio.CancelledError:
+            # the lookup was dropped (reconnect), not this task
+            if future.cancelled():
+                return None
+            raise
+
+    async def _authWait(self, event):
+        """
+        Waits up to authtimeout for <event>, raises ConnectionError right
+        away if the connection is (or goes) away meanwhile
+        """
+        if self._connected:
+            await self._wait(event, self.authtimeout)
+        if not self._connected:
+            raise ConnectionError('Lost the connection while authenticating')
+        return event.is_set()
+
+    async def auth(self, nick):
+        """
+        Login to the IRC server and identify (SASL or nickserv), returns
+        once registered and identified
+        """
+        self._register(nick)
+        if not await self._authWait(self._welcomed):
+            raise RuntimeError('The server did not welcome us')
+        if not self.pswrd:
+            self._authed = True
+            return
+        if not self.sasl:
+            log.info('Waiting on Nickserv...')
+            self._identifyNick(self.pswrd)
+        self._checkAuth(await self._authWait(self._authEvent))
+
+    async def _listen(self):
+        """ Reads the stream until the connection drops """
+        log.info('Listening...')
+        while self._connected:
+            try:
+                data = await asyncio.wait_for(
+                        self._reader.read(4096), self.timeout
+                        )
+            except asyncio.TimeoutError:
+                log.warning('Nothing heard in %ss!', self.timeout)
+                break
+            except (OSError, ssl.SSLError) as e:
+                log.exception(e)
+                break
+            if not data:
+                log.warning('Listen socket closed!')
+                break
+            self._lineBuffer.feed(data)
+            self._sniffLines(self._lineBuffer.lines())
+        self._connected = False
+        self._lost()
+        log.info('No longer listening...')
+
+    async def connect(self):
+        """ Open the connection to the first server that answers """
+        self._lineBuffer.clear()
+        context = ssl.create_default_context() if self.ssl else None
+        for host, port in self._candidates():
+            if not self._running:
+                return
+            log.info("Connecting to %s:%s", host, port)
+            try:
+                self._reader, self._writer = await asyncio.wait_for(
+                        asyncio.open_connection(host, port, ssl=context),
+                        self.timeout
+                        )
+            except (OSError, ssl.SSLError, asyncio.TimeoutError) as e:
+                log.warning('Could not connect to %s:%s: %r', host, port, e)
+                self.metrics.count('connect_errors')
+                await self._wait(self._stopped, self._backoff.next())
+                continue
+            log.info("Connected!")
+            self.host, self.port = host, port
+            self._connected = True
+            self.metrics.count('connects')
+            return
+
+    def _close(self):
+        """ Drops the connection and the state that came with it """
+        if self._writer is not None:
+            self.metrics.count('disconnects')
+        self._connected, self._authed = False, False
+        self._resetState()
+        self._sendq.clear()
+        if self._sendEvent is not None:
+            self._sendEvent.set()
+        self._lost()
+        if self._writer is not None:
+            try:
+                self._writer.close()
+            except Exception as e:
+                log.exception(e)
+        self._writer = None
+
+    def disconnect(self):
+        """ Disconnect from the server (and stop running), from any thread """
+        loop = self._loop
+        if loop is not None and loop.is_running() and \
+                threading.get_ident() != self._loopThread:
+            # a plain command function in the pool (a 'quit' command...)
+            loop.call_soon_threadsafe(self.disconnect)
+            return
+        log.info('Disconnecting...')
+        self._running = False
+        if self._stopped is not None:
+            self._stopped.set()
+        self._close()
+        self._shutdown()
+        log.info('Disconnected!')
+
+    async def run(self):
+        """ Connects (and reconnects) to the server until disconnected """
+        self._loop = asyncio.get_running_loop()
+        self._loopThread = threading.get_ident()
+        self._welcomed, self._authEvent = asyncio.Event(), asyncio.Event()
+        self._sendEvent, self._stopped = asyncio.Event(), asyncio.Event()
+        self._running = True
+        self.compileRe()
+        while self._running:
+            await self.connect()
+            if not self._connected:
+                break
+            listener = self._loop.create_task(self._listen())
+            self._loop.create_task(self._drain())
+            try:
+                await self.auth(self.nick)
+            except ConnectionError as e:
+                log.warning('%s', e)
+                self._close()
+            except Exception as e:
+                log.exception(e)
+                self._close()
+            else:
+                self._autoJoin()
+            await listener
+            self._close()
+            if self._running:
+                delay = self._backoff.next()
+                log.info('Reconnecting in %.1fs', delay)
+                await self._wait(self._stopped, delay)
+
+    def __call__(self):
+        """ Starts the connection to the server (blocks) """
+        asyncio.run(self.run())
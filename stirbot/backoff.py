@@ -0,0 +1,36 @@
+""" Reconnect pacing """
+import random
+
+
+class Backoff(object):
+    """
+    Jittered exponential backoff: the n-th delay is somewhere between
+    half and all of min(<cap>, <base> * <factor>**n) seconds, so bots
+    that lost the same server don't all come back at once
+    """
+    def __init__(self, base=1.0, cap=300.0, factor=2.0):
+        self.base, self.cap, self.factor = base, cap, factor
+        self.attempts = 0
+
+    def next(self):
+        """ The delay before the next attempt """
+        delay = min(self.cap, self.base * self.factor ** self.attempts)
+        if delay < self.cap:
+            self.attempts += 1
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def reset(self):
+        """ The last attempt worked, start over """
+        self.attempts = 0
+
+
+def candidates(hosts, port, ports):
+    """
+    Endless (host, port) cycle over <hosts> and <ports>, starting with
+    the first host on <port>
+    """
+    ports = [port] + [item for item in ports if item != port]
+    while True:
+        for host in hosts:
+            for item in ports:
+                yield host, item
@@ -0,0 +1,310 @@
+""" Broker mode: command lines fanned out to worker processes """
+import multiprocessing
+import os
+import queue
+import shutil
+import socket
+import tempfile
+import threading
+import zlib
+
+from . import IRCServer
+from .framing import LineBuffer
+from .log import log
+
+BROKER = 'stirbot.broker'
+
+
+class _Slot(object):
+    """ One partition: the lines waiting for it and the worker taking them """
+    __slots__ = ('queue', 'peer', 'sent', 'dropped')
+
+    def __init__(self, queuesize):
+        self.queue = queue.Queue(queuesize)
+        self.peer = None
+        self.sent = self.dropped = 0
+
+
+class _Peer(object):
+    """ One connected worker, it is also its writer's stop sentinel """
+    __slots__ = ('sock', 'name', 'slot')
+
+    def __init__(self, sock, name, slot):
+        self.sock, self.name, self.slot = sock, name, slot
+
+
+class Broker(object):
+    """
+    The connection side of broker mode (see IRCServer.startBroker)
+
+    The PRIVMSG/NOTICE lines the bot gets are published over a Unix
+    socket at <path> (in a private temp dir by default) to the connected
+    BrokerWorker processes instead of being matched here. A channel (or
+    the nick, in a private chat) is hashed into one of a fixed number of
+    <partitions>, each taken by one worker, so its commands stay in order
+    however many workers are connected. Lines for a partition no worker
+    has taken (yet, or any more) wait for the next worker that connects,
+    when <queuesize> lines are waiting new ones are dropped. A worker
+    connecting while every partition is taken is turned away. The lines
+    the workers send go through the bot's flood controlled send queue.
+    """
+    def __init__(self, bot, path=None, partitions=4, queuesize=10000):
+        self._tmpdir = None
+        if path is None:
+            self._tmpdir = tempfile.mkdtemp(prefix='stirbot-')
+            path = os.path.join(self._tmpdir, 'broker.sock')
+        self.bot, self.path, self.queuesize = bot, path, queuesize
+        # never resized, a key maps to the same slot for the broker's life
+        self._slots = tuple(_Slot(queuesize) for _ in range(partitions))
+        self._lock = threading.Lock()
+        self._processes = []
+        self._count = 0
+        self.published = self.dropped = self.replies = 0
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(path)
+        self._server.listen()
+        self._running = True
+        self._thread(self._accept, 'accept')
+
+    def _thread(self, target, name, *args):
+        thread = threading.Thread(
+                target=target, args=args, name='stirbot-broker-%s' % name,
+                daemon=True
+                )
+        thread.start()
+        return thread
+
+    def spawn(self, workers, setup, context=None, **options):
+        """
+        Starts <workers> processes running runWorker(path, <setup>),
+        <setup>(worker) adds the commands (it has to be picklable unless
+        the processes are forked), <options> go to BrokerWorker
+        """
+        context = multiprocessing.get_context(context)
+        for i in range(workers):
+            process = context.Process(
+                    target=runWorker, args=(self.path, setup), kwargs=options,
+                    name='stirbot-worker-%d' % i, daemon=True
+                    )
+            process.start()
+            self._processes.append(process)
+        return self._processes
+
+#-------------------------------------------------------------------------------
+    def _welcomeLine(self):
+        """ Tells a worker the bot's nick """
+        return ':%s 001 %s :Broker' % (BROKER, self.bot.nick)
+
+    def publish(self, key, line):
+        """ Hands <line> to the partition <key> (a channel or nick) maps to """
+        slots = self._slots
+        return self._put(
+                slots[zlib.crc32(key.lower().encode('utf-8')) % len(slots)],
+                line
+                )
+
+    def broadcast(self, line):
+        """ Hands <line> to every partition """
+        for slot in self._slots:
+            self._put(slot, line)
+
+    def setNick(self, nick):
+        """ The bot's nick changed """
+        self.broadcast(self._welcomeLine())
+
+    def _put(self, slot, line):
+        try:
+            slot.queue.put_nowait(line)
+        except queue.Full:
+            slot.dropped += 1
+            self.dropped += 1
+            return False
+        self.published += 1
+        return True
+
+#-------------------------------------------------------------------------------
+    def _accept(self):
+        """ Accepts workers (thread) """
+        while self._running:
+            try:
+                sock, _ = self._server.accept()
+            except OSError:
+                break
+            with self._lock:
+                self._count += 1
+                name = 'worker%d' % self._count
+                free = [slot for slot in self._slots if slot.peer is None]
+                peer = _Peer(sock, name, free[0] if free else None)
+                if peer.slot is not None:
+                    peer.slot.peer = peer
+            if peer.slot is None:
+                log.warning('Broker: %s turned away, no free partition', name)
+                sock.close()
+                continue
+            log.info(
+                    'Broker: %s connected (partition %d)',
+                    name, self._slots.index(peer.slot)
+                    )
+            try:
+                # before the writer starts, so it comes first
+                sock.sendall((self._welcomeLine() + '\n').encode('utf-8'))
+            except OSError:
+                self._drop(peer)
+                continue
+            self._thread(self._writer, name + '-writer', peer)
+            self._thread(self._reader, name + '-reader', peer)
+
+    def _writer(self, peer):
+        """ Sends a worker its lines, as many per write as are waiting """
+        slot, stop = peer.slot, False
+        while not stop:
+            lines = []
+            item = slot.queue.get()
+            while True:
+                if item is peer:
+                    stop = True
+                    break
+                # a stop meant for a worker that had this slot before
+                if not isinstance(item, _Peer):
+                    lines.append(item)
+                try:
+                    item = slot.queue.get_nowait()
+                except queue.Empty:
+                    break
+            try:
+                if lines:
+                    peer.sock.sendall(
+                            ''.join(line + '\n' for line in lines).encode('utf-8')
+                            )
+                    slot.sent += len(lines)
+            except OSError:
+                stop = True
+        self._drop(peer)
+
+    def _reader(self, peer):
+        """ Sends what a worker wrote to the server """
+        buffer = LineBuffer()
+        try:
+            while buffer.readFrom(peer.sock):
+                for line in buffer.lines():
+                    self.replies += 1
+                    self.bot._send(line)
+        except OSError:
+            pass
+        self._drop(peer)
+        try:
+            peer.slot.queue.put_nowait(peer)
+        except queue.Full:
+            # the writer fails on the closed socket instead
+            pass
+
+    def _drop(self, peer):
+        """ Forgets a worker that went away, its partition waits for another """
+        with self._lock:
+            if peer.slot.peer is not peer:
+                return
+            peer.slot.peer = None
+        log.warning('Broker: %s disconnected', peer.name)
+        try:
+            peer.sock.close()
+        except OSError:
+            pass
+
+    def stats(self):
+        return {
+                'partitions': [{
+                        'worker': slot.peer.name if slot.peer else None,
+                        'queued': slot.queue.qsize(),
+                        'sent': slot.sent,
+                        'dropped': slot.dropped
+                        } for slot in self._slots],
+                'published': self.published,
+                'dropped': self.dropped,
+                'replies': self.replies
+                }
+
+    def close(self):
+        """ Disconnects the workers and stops the spawned processes """
+        self._running = False
+        try:
+            # wakes the accept thread up
+            self._server.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._server.close()
+        for slot in self._slots:
+            peer = slot.peer
+            if peer is None:
+                continue
+            try:
+                peer.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        for process in self._processes:
+            process.join(5)
+            if process.is_alive():
+                process.terminate()
+        self._processes = []
+        if self._tmpdir is not None:
+            shutil.rmtree(self._tmpdir, ignore_errors=True)
+        elif os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class BrokerWorker(IRCServer):
+    """
+    The worker side of broker mode: gets the lines a Broker publishes,
+    matches and runs its commands (addCommand, loadCommands, plugins...
+    as usual, with limits, caches and its own worker threads) and sends
+    what they send back to the broker. It knows the bot's nick but
+    nothing else about the connection (bot.members stays empty here).
+    """
+    def __init__(self, path, threads=4, **kwargs):
+        IRCServer.__init__(
+                self, 'stirbot', host=BROKER, autojoin=[], threads=threads,
+                **kwargs
+                )
+        self.path = path
+        self._sendLock = threading.Lock()
+        self._serverCmds = {
+                '001': self._welcome,
+                'NICK': self._nickChanged,
+                'PRIVMSG': self._sniffMessage,
+                'NOTICE': self._gotNotice
+                }
+
+    def _send(self, message):
+        """ Hands a line to the broker (any thread) """
+        line = message.replace('\r', ' ').replace('\n', ' ') + '\n'
+        with self._sendLock:
+            sock = self._sock
+            if sock is None:
+                raise socket.error('Not connected')
+            sock.sendall(line.encode('utf-8'))
+
+    def run(self):
+        """ Handles what the broker sends until it goes away (blocks) """
+        self.compileRe()
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.connect(self.path)
+        self._connected = self._running = True
+        try:
+            while self._lineBuffer.readFrom(self._sock):
+                self._sniffLines(self._lineBuffer.lines())
+        except OSError as e:
+            log.warning('Lost the broker: %r', e)
+        self._running = self._connected = False
+        self._workers.clear()
+        self._stopOffload()
+        with self._sendLock:
+            self._sock.close()
+            self._sock = None
+
+    __call__ = run
+
+
+def runWorker(path, setup, **options):
+    """ A worker process: setup(worker) adds the commands, then run() """
+    worker = BrokerWorker(path, **options)
+    setup(worker)
+    worker.run()
@@ -0,0 +1,261 @@
+""" Channel membership store """
+import sys
+
+# member mode bit flags
+VOICE, HALFOP, OP, ADMIN, OWNER = 1, 2, 4, 8, 16
+MODEFLAGS = {
+        'v': VOICE, 'V': VOICE, 'h': HALFOP,
+        'o': OP, 'O': OP, 'a': ADMIN, 'q': OWNER
+        }
+# NAMES prefix symbol -> mode, until the server tells us its PREFIX
+DEFAULTPREFIX = {'@': 'o', '+': 'v'}
+
+
+def parsePrefix(value):
+    """ ISUPPORT PREFIX=(qaohv)~&@%+ -> {'~': 'q', '&': 'a', ...} """
+    if not value.startswith('(') or ')' not in value:
+        return dict(DEFAULTPREFIX)
+    modes, symbols = value[1:].split(')', 1)
+    return dict(zip(symbols, modes))
+
+
+def parseNames(names, prefixes, members=None, hosts=None):
+    """
+    Adds the names of a 353 to <members> ({'nick': flags}), every
+    leading prefix symbol is read (multi-prefix) and nick!user@host
+    names (userhost-in-names) go to <hosts> ({'nick': 'user@host'})
+    """
+    if members is None:
+        members = {}
+    for name in names.split():
+        flags = 0
+        while name and name[0] in prefixes:
+            flags |= MODEFLAGS.get(prefixes[name[0]], 0)
+            name = name[1:]
+        if '!' in name:
+            name, _, host = name.partition('!')
+            if hosts is not None:
+                hosts[name] = host
+        if name:
+            members[name] = members.get(name, 0) | flags
+    return members
+
+
+class User(object):
+    """ A nick we share at least one channel with """
+    __slots__ = ('nick', 'acc', 'channels', 'host', 'away')
+
+    def __init__(self, nick):
+        self.nick = nick
+        self.acc = 0
+        self.channels = set()
+        # user@host and away message (None when here) if the server told us
+        self.host = self.away = None
+
+
+class Channel(object):
+    """ Base class for channels"""
+    __slots__ = ('name', 'members', 'modes', 'topic', '_users')
+
+    def __init__(self, name=None, users=None):
+        self.name = name
+        # {'nick': mode flags}
+        self.members = {}
+        self.modes = []
+        self.topic = ""
+        # Membership.users, for the ACC levels
+        self._users = users if users is not None else {}
+
+    @property
+    def users(self):
+        """ {'nick': ACC level} of everyone here (mode flags: members) """
+        users = self._users
+        return dict(
+                (nick, users[nick].acc if nick in users else 0)
+                for nick in self.members
+                )
+
+    @property
+    def ops(self):
+        """ Nicks with +o """
+        return [nick for nick, flags in self.members.items() if flags & OP]
+
+    @property
+    def voices(self):
+        """ Nicks with +v """
+        return [nick for nick, flags in self.members.items() if flags & VOICE]
+
+    def hasMode(self, nick, flag):
+        """ If <nick> is in the channel with <flag> set """
+        return bool(self.members.get(nick, 0) & flag)
+
+
+class Membership(object):
+    """
+    Who is in which channel, indexed both ways
+
+    channels: {'#channel': Channel} (Channel.members: {'nick': flags})
+    users: {'nick': User} (User.channels: set of channel names)
+
+    Nicks are interned and every update only touches the channels of the
+    user involved, so a QUIT/NICK costs O(channels of that user) instead
+    of a scan of every channel.
+    """
+    __slots__ = ('channels', 'users')
+
+    def __init__(self):
+        self.channels = {}
+        self.users = {}
+
+    def clear(self):
+        """ Forget everything (in place, self.channels is shared) """
+        self.channels.clear()
+        self.users.clear()
+
+    def channel(self, name):
+        """ Get (or create) a channel """
+        channel = self.channels.get(name)
+        if channel is None:
+            channel = self.channels[name] = Channel(name, self.users)
+        return channel
+
+    def _user(self, nick):
+        """ Get (or create) a user with an interned nick """
+        user = self.users.get(nick)
+        if user is None:
+            nick = sys.intern(nick)
+            user = self.users[nick] = User(nick)
+        return user
+
+    def join(self, name, nick, flags=0, host=None):
+        """ <nick> is in channel <name> (with mode <flags> added) """
+        user = self._user(nick)
+        members = self.channel(name).members
+        members[user.nick] = members.get(user.nick, 0) | flags
+        user.channels.add(name)
+        if host is not None:
+            user.host = host
+
+    def part(self, name, nick):
+        """ <nick> left channel <name> """
+        channel = self.channels.get(name)
+        if channel is not None:
+            channel.members.pop(nick, None)
+        user = self.users.get(nick)
+        if user is not None:
+            user.channels.discard(name)
+            if not user.channels:
+                del self.users[nick]
+
+    def quit(self, nick):
+        """ <nick> left the network, returns the channels they were in """
+        user = self.users.pop(nick, None)
+        if user is None:
+            return set()
+        channels = self.channels
+        for name in user.channels:
+            channel = channels.get(name)
+            if channel is not None:
+                channel.members.pop(nick, None)
+        return user.channels
+
+    def quitMany(self, nicks):
+        """ Everyone in <nicks> left (a netsplit), returns how many we knew """
+        users, channels, gone = self.users, self.channels, 0
+        for nick in nicks:
+            user = users.pop(nick, None)
+            if user is None:
+                continue
+            gone += 1
+            for name in user.channels:
+                channel = channels.get(name)
+                if channel is not None:
+                    channel.members.pop(nick, None)
+        return gone
+
+    def rename(self, old, new):
+        """ <old> is now known as <new> """
+        user = self.users.pop(old, None)
+        if user is None:
+            return
+        user.nick = sys.intern(new)
+        self.users[user.nick] = user
+        channels = self.channels
+        for name in user.channels:
+            members = channels[name].members
+            members[user.nick] = members.pop(old, 0)
+
+    def sync(self, name, members, hosts=None):
+        """
+        Replaces the members of channel <name> with <members> (a complete
+        NAMES list) in one go, the new Channel is swapped in whole so
+        readers see either the old or the new member list, <hosts> are
+        the user@hosts that came with the names
+        """
+        old = self.channels.get(name)
+        channel = Channel(name, self.users)
+        if old is not None:
+            channel.topic, channel.modes = old.topic, old.modes
+        user = self._user
+        synced = channel.members
+        for nick, flags in members.items():
+            member = user(nick)
+            member.channels.add(name)
+            synced[member.nick] = flags
+        if hosts:
+            users = self.users
+            for nick, host in hosts.items():
+                if nick in users:
+                    users[nick].host = host
+        self.channels[name] = channel
+        if old is None:
+            return channel
+        users = self.users
+        for nick in old.members:
+            if nick not in synced:
+                member = users.get(nick)
+                if member is not None:
+                    member.channels.discard(name)
+                    if not member.channels:
+                        del users[nick]
+        return channel
+
+    def drop(self, name):
+        """ We left channel <name> """
+        channel = self.channels.pop(name, None)
+        if channel is None:
+            return
+        users = self.users
+        for nick in channel.members:
+            user = users.get(nick)
+            if user is not None:
+                user.channels.discard(name)
+                if not user.channels:
+                    del users[nick]
+
+    def setMode(self, name, nick, flag, on=True):
+        """ Set/unset a member mode flag """
+        channel = self.channels.get(name)
+        if channel is None or nick not in channel.members:
+            return
+        if on:
+            channel.members[nick] |= flag
+        else:
+            channel.members[nick] &= ~flag
+
+    def setAway(self, nick, message):
+        """ <nick> is away with <message> (None: back) """
+        user = self.users.get(nick)
+        if user is not None:
+            user.away = message
+
+    def setAcc(self, nick, acc):
+        """ Remember the NickServ ACC level of <nick> """
+        user = self.users.get(nick)
+        if user is not None:
+            user.acc = acc
+
+    def acc(self, nick):
+        """ Last known ACC level of <nick> (0 if unknown) """
+        user = self.users.get(nick)
+        return user.acc if user is not None else 0
@@ -0,0 +1,71 @@
+""" Incremental line framing for the IRC socket stream """
+
+MAXLINE = 16384
+
+
+class LineBuffer(object):
+    """
+    Collects raw bytes from the socket and hands back complete lines
+
+    A line is only decoded once its terminator has arrived, so messages
+    (and multi-byte characters) split across reads are never broken up.
+    Lines that are not valid utf-8 are decoded with <fallback> instead
+    of being dropped.
+    """
+    def __init__(
+                self, size=4096, encoding='utf-8', fallback='latin-1',
+                maxline=MAXLINE
+                ):
+        self.encoding, self.fallback = encoding, fallback
+        self.maxline = maxline
+        self._buffer = bytearray()
+        self._chunk = bytearray(size)
+        self._view = memoryview(self._chunk)
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def clear(self):
+        """ Throw away any partial line (used on reconnect) """
+        del self._buffer[:]
+
+    def readFrom(self, sock):
+        """
+        recv_into the reusable chunk and append it to the buffer,
+        returns the number of bytes read (0 means the socket closed)
+        """
+        size = sock.recv_into(self._chunk)
+        if size:
+            self._buffer += self._view[:size]
+        return size
+
+    def feed(self, data):
+        """ Append already received bytes to the buffer """
+        self._buffer += data
+
+    def decode(self, raw):
+        """ Decode a single line, never raises on bad bytes """
+        try:
+            return raw.decode(self.encoding)
+        except UnicodeDecodeError:
+            return raw.decode(self.fallback, 'replace')
+
+    def lines(self):
+        """
+        Pops every complete line out of the buffer, the partial tail
+        (if any) is kept for the next read
+        """
+        buf = self._buffer
+        end = buf.rfind(b'\n')
+        if end < 0:
+            if len(buf) > self.maxline:
+                # no terminator in sight, this is not irc
+                del buf[:]
+            return []
+        chunk = bytes(buf[:end])
+        del buf[:end + 1]
+        decode = self.decode
+        return [
+                decode(raw.rstrip(b'\r'))
+                for raw in chunk.split(b'\n') if raw and raw != b'\r'
+                ]
@@ -0,0 +1,141 @@
+""" Rate limits, cooldowns and result caching for commands """
+import threading
+import time
+from collections import OrderedDict
+
+# what a limit can be kept per (or a tuple of them)
+PER = ('nick', 'host', 'channel', 'global')
+
+# limits can be shared between commands, one lock keeps them consistent
+_lock = threading.Lock()
+
+
+class RateLimit(object):
+    """
+    Token bucket per <per> ('nick', 'host', 'channel', 'global' or a
+    tuple of them like ('channel', 'nick')): up to <burst> calls at once,
+    then <rate> calls a second. At most <maxkeys> buckets are kept, the
+    least recently used ones are forgotten first.
+    """
+    def __init__(self, rate, burst=1, per='nick', maxkeys=10000):
+        per = (per,) if isinstance(per, str) else tuple(per)
+        for item in per:
+            if item not in PER:
+                raise ValueError('per must be one of %s' % str(PER))
+        self.rate, self.burst, self.per = float(rate), burst, per
+        self.maxkeys = maxkeys
+        # key -> [tokens, last refill]
+        self._buckets = OrderedDict()
+        self.allowed = self.limited = 0
+
+    def key(self, chan, nick, host):
+        """ The bucket a call from <nick>@<host> in <chan> goes to """
+        values = {'nick': nick, 'host': host, 'channel': chan, 'global': None}
+        return tuple(values[item] for item in self.per)
+
+    def ready(self, key, now):
+        """ Refills the bucket, True if it has a token (lock held) """
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            return True
+        bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        self._buckets.move_to_end(key)
+        return bucket[0] >= 1
+
+    def take(self, key, now):
+        """ Takes a token (lock held, after ready()) """
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [float(self.burst), now]
+            if len(self._buckets) > self.maxkeys:
+                self._buckets.popitem(last=False)
+        bucket[0] -= 1
+        self.allowed += 1
+
+    def stats(self):
+        return {
+                'allowed': self.allowed,
+                'limited': self.limited,
+                'keys': len(self._buckets)
+                }
+
+
+class Cooldown(RateLimit):
+    """ One call per <seconds> per <per> """
+    def __init__(self, seconds, per='nick', maxkeys=10000):
+        RateLimit.__init__(self, 1.0 / seconds, 1, per, maxkeys)
+        self.seconds = seconds
+
+
+def allow(limits, chan, nick, host):
+    """
+    Takes a token from every one of <limits>, or none at all (and returns
+    False) if one of them is out
+    """
+    now = time.monotonic()
+    with _lock:
+        keys = [limit.key(chan, nick, host) for limit in limits]
+        for limit, key in zip(limits, keys):
+            if not limit.ready(key, now):
+                limit.limited += 1
+                return False
+        for limit, key in zip(limits, keys):
+            limit.take(key, now)
+    return True
+
+
+class ResultCache(object):
+    """
+    TTL + LRU cache of command results keyed on the command name and the
+    match groups, at most <maxsize> results are kept for <ttl> seconds
+    """
+    def __init__(self, ttl=60, maxsize=256):
+        self.ttl, self.maxsize = ttl, maxsize
+        # key -> (expires, result)
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.expired = self.evicted = 0
+
+    def get(self, key):
+        """ The cached result for <key>, or None """
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            if item[0] < time.monotonic():
+                del self._items[key]
+                self.expired += 1
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def put(self, key, result):
+        """ Remembers <result> (None is never cached) """
+        if result is None:
+            return
+        with self._lock:
+            self._items[key] = (time.monotonic() + self.ttl, result)
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+                self.evicted += 1
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+    def stats(self):
+        return {
+                'size': len(self._items),
+                'hits': self.hits,
+                'misses': self.misses,
+                'expired': self.expired,
+                'evicted': self.evicted
+                }
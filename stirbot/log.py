@@ -0,0 +1,48 @@
+""" Lazy logging for the per-line protocol path """
+import atexit
+import logging
+import queue
+
+# everything the bot logs, raw protocol lines go to the trace child
+log = logging.getLogger('stirbot')
+trace = logging.getLogger('stirbot.trace')
+
+
+class Lazy(object):
+    """ A log argument that is only computed if the record is emitted """
+    __slots__ = ('func', 'args')
+
+    def __init__(self, func, *args):
+        self.func, self.args = func, args
+
+    def __str__(self):
+        return str(self.func(*self.args))
+
+
+def queueLogging(logger=None, handlers=None, size=-1):
+    """
+    Moves the handlers of <logger> (the root logger by default), or the
+    given <handlers>, behind a QueueHandler so slow handlers (files,
+    sockets) are written from a background thread and never block the
+    reader. Returns the started QueueListener (it is stopped at exit).
+    """
+    from logging.handlers import QueueHandler, QueueListener
+    if logger is None:
+        logger = logging.getLogger()
+    if handlers is None:
+        handlers = list(logger.handlers)
+    for handler in list(logger.handlers):
+        if handler in handlers:
+            logger.removeHandler(handler)
+    records = queue.Queue(size)
+    logger.addHandler(QueueHandler(records))
+    listener = QueueListener(records, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(_stop, listener)
+    return listener
+
+
+def _stop(listener):
+    """ Flushes and stops a listener (unless it was stopped already) """
+    if listener._thread is not None:
+        listener.stop()
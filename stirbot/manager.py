@@ -0,0 +1,205 @@
+""" Runs many server connections in one process """
+import asyncio
+import contextvars
+import threading
+
+from . import CommandSet
+from .aio import AsyncIRCServer
+from .log import log
+from .matcher import CommandIndex
+from .metrics import isCoroutineFunction
+from .workers import SerialPool
+
+_current = contextvars.ContextVar('stirbot_network', default=None)
+
+
+class ManagedServer(AsyncIRCServer):
+    """ An AsyncIRCServer whose commands and pool belong to a BotManager """
+    def __init__(self, manager, name, nick, **kwargs):
+        self.manager, self.name = manager, name
+        kwargs['pool'] = manager._workers
+        AsyncIRCServer.__init__(self, nick, **kwargs)
+        self.commands = manager.commands
+        self._commandIndex = manager._commandIndex
+
+    def _buildIndex(self):
+        """ The index is shared, let the manager rebuild it for everyone """
+        self.manager._buildIndex()
+
+    def updateCommands(self, add=None, remove=()):
+        """ The commands are shared, the manager updates everyone """
+        self.manager.updateCommands(add, remove)
+
+    def _getOffload(self):
+        """ The process pool is shared too """
+        return self.manager._getOffload()
+
+    def _stopOffload(self):
+        """ The manager owns the process pool """
+
+    def _stopWorkers(self):
+        """ Drops this network's queued commands from the shared pool """
+        self._workers.clear(lambda key: key[0] == self.name)
+
+    @property
+    def network(self):
+        """ Events are stored under the network name """
+        return self.name
+
+    def _runCommand(self, name, handle, chan, nick, host, match):
+        """ Runs the command with this network as BotManager.current """
+        func = self._commandFunction(name, handle)
+        if isCoroutineFunction(func):
+            context = contextvars.copy_context()
+            context.run(_current.set, self)
+            # the task copies the context it is created in
+            task = context.run(
+                    self._loop.create_task, func(chan, nick, host, match)
+                    )
+            self._tasks.add(task)
+            task.add_done_callback(self._taskDone)
+        else:
+            self._workers.submit(
+                    self._orderKey(chan, nick), self._runWith,
+                    func, chan, nick, host, match
+                    )
+
+    def _orderKey(self, chan, nick):
+        """ Keep the ordering per network too """
+        return self.name, AsyncIRCServer._orderKey(self, chan, nick)
+
+    def _runWith(self, func, chan, nick, host, match):
+        """ Runs a plain command function in a pool thread """
+        token = _current.set(self)
+        try:
+            func(chan, nick, host, match)
+        finally:
+            _current.reset(token)
+
+
+class BotManager(CommandSet):
+    """
+    Multiplexes many server connections over one asyncio loop
+
+    All networks share one commands dict (and its compiled index) and one
+    bounded pool for plain command functions, their server state
+    (channels, servHost, nick...) is kept on each network's server.
+    A <store> (store.Store) is shared too, events are kept under the
+    network name.
+    Command functions keep the (chan, nick, host, match) signature, use
+    BotManager.current to get the network the command came from:
+
+        manager = BotManager()
+        manager.addNetwork('freenode', 'stirbot', host='chat.freenode.net')
+        manager.addNetwork('efnet', 'stirbot', host='irc.efnet.org')
+
+        def hello(chan, nick, host, match):
+            manager.current.sendMessage(chan, 'Hello there %s!' % nick)
+
+        manager.addCommand('hello', r'^!hello', hello)
+        manager()
+    """
+    def __init__(
+                self, threads=4, combine=False, queuesize=1000, overflow='drop',
+                metrics=False, store=None
+                ):
+        self.threads, self.combine, self.metrics = threads, combine, metrics
+        self.store = store
+        self.networks = {}
+        self.commands = {}
+        self._workers = SerialPool(threads, queuesize, overflow)
+        # made when a command needs it (multiprocessing is slow to import)
+        self._offload = None
+        self._commandIndex = CommandIndex(self.commands)
+        self._commandsLock = threading.Lock()
+        self._loop = self._done = None
+        self._tasks = {}
+
+    @property
+    def current(self):
+        """ The network server the running command was triggered on """
+        return _current.get()
+
+    def addNetwork(self, name, nick, **kwargs):
+        """
+        Add a network (kwargs are passed on to AsyncIRCServer), it is
+        connected by run() or right away if the manager is running
+        """
+        kwargs.setdefault('metrics', self.metrics)
+        kwargs.setdefault('store', self.store)
+        server = ManagedServer(self, name, nick, **kwargs)
+        self.networks[name] = server
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._start, name)
+        log.info('Network: %s added!', name)
+        return server
+
+    def removeNetwork(self, name):
+        """ Disconnect and forget a network """
+        server = self.networks.pop(name)
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(server.disconnect)
+        else:
+            server.disconnect()
+        log.info('Network: %s removed!', name)
+
+    def stats(self):
+        """ stats() of every network and the shared pool """
+        stats = {
+                'networks': dict(
+                        (name, server.stats())
+                        for name, server in list(self.networks.items())
+                        ),
+                'workers': self._workers.stats()
+                }
+        if self._offload is not None:
+            stats['offload'] = self._offload.stats()
+        return stats
+#-------------------------------------------------------------------------------
+    def _setCommands(self, commands, index):
+        """ Swaps the new commands in for every network too """
+        self.commands, self._commandIndex = commands, index
+        for server in list(self.networks.values()):
+            server.commands, server._commandIndex = commands, index
+
+    def _buildIndex(self):
+        """
+        Rebuilds the shared command index and hands it (and the commands)
+        to every network
+        """
+        CommandSet._buildIndex(self)
+        for server in list(self.networks.values()):
+            server.commands = self.commands
+            server._commandIndex = self._commandIndex
+#-------------------------------------------------------------------------------
+    def _start(self, name):
+        """ Schedules a network's run() on the loop """
+        if name not in self.networks or name in self._tasks:
+            return
+        task = self._loop.create_task(self.networks[name].run())
+        self._tasks[name] = task
+        task.add_done_callback(lambda task: self._stopped(name, task))
+
+    def _stopped(self, name, task):
+        """ Forgets a network that stopped running """
+        if self._tasks.get(name) is task:
+            del self._tasks[name]
+        if not task.cancelled() and task.exception() is not None:
+            log.error('Network %s failed: %r', name, task.exception())
+        if not self._tasks:
+            self._done.set()
+
+    async def run(self):
+        """ Runs every network until they are all disconnected """
+        self._loop = asyncio.get_running_loop()
+        self._done = asyncio.Event()
+        for name in list(self.networks):
+            self._start(name)
+        if self._tasks:
+            await self._done.wait()
+        self._stopOffload()
+        self._loop = None
+
+    def __call__(self):
+        """ Starts every network (blocks) """
+        asyncio.run(self.run())
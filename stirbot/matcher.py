@@ -0,0 +1,229 @@
+""" Compiled matching index for user commands """
+import re
+from functools import lru_cache
+
+from .log import log
+
+try:
+    from re import _parser as sre_parse
+    from re._constants import (
+            AT, AT_BEGINNING, AT_BEGINNING_STRING, BRANCH, GROUPREF,
+            GROUPREF_EXISTS, LITERAL, SUBPATTERN
+            )
+except ImportError:
+    import sre_parse
+    from sre_constants import (
+            AT, AT_BEGINNING, AT_BEGINNING_STRING, BRANCH, GROUPREF,
+            GROUPREF_EXISTS, LITERAL, SUBPATTERN
+            )
+
+
+def _flatten(items):
+    """ Inline plain groups so their literals join the outer sequence """
+    for op, av in items:
+        if op is SUBPATTERN and not av[1] and not av[2]:
+            for item in _flatten(av[3]):
+                yield item
+        else:
+            yield op, av
+
+
+def _literalRuns(items):
+    """
+    Returns if the sequence is anchored to the start, its leading literal
+    (only if anchored) and the longest literal run any match must contain
+    """
+    runs, run, start = [], [], None
+    anchored = False
+    for i, (op, av) in enumerate(_flatten(items)):
+        if op is LITERAL:
+            if not run:
+                start = i
+            run.append(chr(av))
+            continue
+        if run:
+            runs.append((start, ''.join(run)))
+            run = []
+        if i == 0 and op is AT and av in (AT_BEGINNING, AT_BEGINNING_STRING):
+            anchored = True
+    if run:
+        runs.append((start, ''.join(run)))
+    prefix = None
+    if anchored and runs and runs[0][0] == 1:
+        prefix = runs[0][1]
+    longest = max((text for _, text in runs), key=len, default=None)
+    return anchored, prefix, longest
+
+
+def _subPatterns(av):
+    """ Nested patterns inside an opcode argument """
+    if isinstance(av, sre_parse.SubPattern):
+        yield av
+    elif isinstance(av, (list, tuple)):
+        for item in av:
+            for sub in _subPatterns(item):
+                yield sub
+
+
+def _hasGroupRef(items):
+    """ True if the pattern refers back to one of its own groups """
+    for op, av in items:
+        if op is GROUPREF or op is GROUPREF_EXISTS:
+            return True
+        for sub in _subPatterns(av):
+            if _hasGroupRef(sub):
+                return True
+    return False
+
+
+@lru_cache(maxsize=None)
+def compilePattern(pattern, flags=0):
+    """
+    re.compile for the whole process: a regex shared by bots, networks
+    and reloads is compiled once (re's own cache only keeps 512)
+    """
+    return re.compile(pattern, flags)
+
+
+GLOBALFLAGS = re.compile(r'^\(\?[aiLmsux]+\)')
+SCOPEDFLAGS = ((re.ASCII, 'a'), (re.IGNORECASE, 'i'), (re.MULTILINE, 'm'),
+               (re.DOTALL, 's'), (re.VERBOSE, 'x'))
+
+
+def _scoped(regex):
+    """ The pattern with its flags scoped to it, so it can be alternated """
+    pattern = regex.pattern
+    while GLOBALFLAGS.match(pattern):
+        pattern = GLOBALFLAGS.sub('', pattern, 1)
+    letters = ''.join(
+            letter for flag, letter in SCOPEDFLAGS if regex.flags & flag
+            )
+    if letters:
+        return '(?%s:%s)' % (letters, pattern)
+    return '(?:%s)' % pattern
+
+
+@lru_cache(maxsize=None)
+def analyze(pattern, flags):
+    """
+    Works out what a message needs to contain before <pattern> can match,
+    returns (anchored, prefix, keywords, combinable):
+        anchored: the pattern can only match at the start of a message
+        prefix: literal the message must start with (or None)
+        keywords: tuple of literals, at least one must be in the message
+                  (or None if nothing is required)
+        combinable: if the pattern can be safely put in an alternation
+    """
+    try:
+        parsed = sre_parse.parse(pattern, flags)
+    except Exception as e:
+        log.debug('Could not analyze %r: %s', pattern, e)
+        return False, None, None, False
+    flags = parsed.state.flags
+    combinable = not parsed.state.groupdict and not _hasGroupRef(parsed)
+    items = list(parsed)
+    while len(items) == 1 and items[0][0] is SUBPATTERN and \
+            not items[0][1][1] and not items[0][1][2]:
+        items = list(items[0][1][3])
+    if len(items) == 1 and items[0][0] is BRANCH:
+        if flags & re.IGNORECASE:
+            return False, None, None, combinable
+        keywords = []
+        for branch in items[0][1][1]:
+            keyword = _literalRuns(branch)[2]
+            if not keyword:
+                return False, None, None, combinable
+            keywords.append(keyword)
+        return False, None, tuple(dict.fromkeys(keywords)), combinable
+    anchored, prefix, keyword = _literalRuns(items)
+    if flags & re.MULTILINE:
+        anchored = False
+    if flags & re.IGNORECASE or not anchored:
+        prefix = None
+    if flags & re.IGNORECASE or not keyword:
+        return anchored, prefix, None, combinable
+    return anchored, prefix, (keyword,), combinable
+
+
+class CommandIndex(object):
+    """
+    Prefiltering index over a commands dict
+
+    Every regex is tried in the same order as a plain scan of the dict
+    would (command order, then regex order) but only if the message
+    could possibly match it:
+        anchored literal triggers (r'^!cmd') are found with a prefix trie
+        other regex are skipped unless a literal they require is present
+        the rest are tried directly (optionally behind a combined regex
+        that rejects messages none of them can match)
+    """
+    def __init__(self, commands, combine=False):
+        self._trie = {}
+        keywords = {}
+        # [entries, scoped patterns, combined regex, use match()]
+        self._rest = [[[], [], None, True], [[], [], None, False]]
+        priority = 0
+        for name in list(commands):
+            handle = commands[name]
+            for regex in handle.cregex:
+                entry = (priority, name, regex, handle)
+                priority += 1
+                anchored, prefix, words, combinable = \
+                        analyze(regex.pattern, regex.flags)
+                if prefix:
+                    node = self._trie
+                    for char in prefix:
+                        node = node.setdefault(char, {})
+                    node.setdefault(None, []).append(entry)
+                elif words:
+                    for word in words:
+                        keywords.setdefault(word, []).append(entry)
+                else:
+                    group = self._rest[0 if anchored else 1]
+                    group[0].append(entry)
+                    group[1].append(_scoped(regex) if combinable else None)
+        self._keywords = list(keywords.items())
+        for group in self._rest:
+            entries, patterns = group[0], group[1]
+            if combine and len(entries) > 1 and None not in patterns:
+                try:
+                    group[2] = re.compile('|'.join(patterns))
+                except re.error as e:
+                    log.debug('Could not combine command regex: %s', e)
+        self._rest = [group for group in self._rest if group[0]]
+        self.size = priority
+
+    def candidates(self, message):
+        """ Entries that could match <message>, in priority order """
+        found = []
+        node = self._trie
+        for char in message:
+            node = node.get(char)
+            if node is None:
+                break
+            if None in node:
+                found.extend(node[None])
+        for word, entries in self._keywords:
+            if word in message:
+                found.extend(entries)
+        for entries, _, combined, anchored in self._rest:
+            if combined is None:
+                found.extend(entries)
+            elif anchored and combined.match(message):
+                found.extend(entries)
+            elif not anchored and combined.search(message):
+                found.extend(entries)
+        if len(found) > 1:
+            found = sorted(set(found), key=lambda entry: entry[0])
+        return found
+
+    def match(self, message):
+        """
+        Returns (name, handle, match) for the first command that matches
+        <message>, or None
+        """
+        for _, name, regex, handle in self.candidates(message):
+            match = regex.search(message)
+            if match:
+                return name, handle, match
+        return None
@@ -0,0 +1,303 @@
+""" Counters, latency histograms and a sampling profiler """
+import bisect
+import functools
+import sys
+import threading
+import time
+
+from .log import log
+
+# histogram bucket upper bounds in seconds (+Inf is implied)
+BUCKETS = (
+        0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+        0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+        0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+        )
+# inspect.CO_COROUTINE (inspect itself is slow to import)
+CO_COROUTINE = 0x80
+
+
+def isCoroutineFunction(func):
+    """ inspect.iscoroutinefunction (functions, methods and partials) """
+    while isinstance(func, functools.partial):
+        func = func.func
+    code = getattr(getattr(func, '__func__', func), '__code__', None)
+    return code is not None and bool(code.co_flags & CO_COROUTINE)
+
+
+class Histogram(object):
+    """ Fixed bucket latency histogram """
+    __slots__ = ('counts', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = self.max = 0.0
+
+    def observe(self, secs):
+        self.counts[bisect.bisect_left(BUCKETS, secs)] += 1
+        self.count += 1
+        self.total += secs
+        if secs > self.max:
+            self.max = secs
+
+    def quantile(self, q):
+        """ Upper bound of the bucket the <q> quantile falls in """
+        if not self.count:
+            return 0.0
+        rank, seen = q * self.count, 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return BUCKETS[i] if i < len(BUCKETS) else self.max
+        return self.max
+
+    def snapshot(self):
+        return {
+                'count': self.count,
+                'sum': self.total,
+                'max': self.max,
+                'p50': self.quantile(0.50),
+                'p90': self.quantile(0.90),
+                'p99': self.quantile(0.99)
+                }
+
+
+class Metrics(object):
+    """
+    Counters and per handler latency histograms of a bot
+
+    Histograms are kept per (kind, name):
+        'server': server command/numeric handlers (PRIVMSG includes the
+                  command lookup)
+        'match': the command lookup of a message, by the command found
+        'regex': custom server regex functions
+        'command': command functions, 'wait' the time they queued first
+        'reader': time from a read to its last line being handled
+        'write': socket writes of the send queue
+    Command CPU time is kept per command name. Nothing but the counters
+    is recorded while <enabled> is False.
+    """
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.counters = {}
+        self.histograms = {}
+        self.cpu = {}
+        # thread ident -> name of the command running on it
+        self.running = {}
+        self._lock = threading.Lock()
+        self._sampler = None
+
+    def count(self, name, value=1):
+        """ Adds to a counter (always on, these are rare events) """
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, kind, name, secs):
+        """ Records one latency sample """
+        key = (kind, name)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(secs)
+
+    def timed(self, name, func):
+        """ Wraps a command function to record its wait, run and cpu time """
+        queued = time.perf_counter()
+        if isCoroutineFunction(func):
+            @functools.wraps(func)
+            async def timedCoroutine(*args):
+                start = time.perf_counter()
+                self.observe('wait', name, start - queued)
+                try:
+                    return await func(*args)
+                finally:
+                    self.observe('command', name, time.perf_counter() - start)
+            return timedCoroutine
+
+        @functools.wraps(func)
+        def timedFunction(*args):
+            ident = threading.get_ident()
+            start, cpu = time.perf_counter(), time.thread_time()
+            self.observe('wait', name, start - queued)
+            self.running[ident] = name
+            try:
+                return func(*args)
+            finally:
+                self.running.pop(ident, None)
+                self.observe('command', name, time.perf_counter() - start)
+                cpu = time.thread_time() - cpu
+                with self._lock:
+                    self.cpu[name] = self.cpu.get(name, 0.0) + cpu
+        return timedFunction
+
+    def reset(self):
+        """ Forget every sample (counters included) """
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+            self.cpu.clear()
+
+    def snapshot(self):
+        """ Plain dict of everything recorded so far """
+        with self._lock:
+            latency = {}
+            for (kind, name), histogram in self.histograms.items():
+                latency.setdefault(kind, {})[name] = histogram.snapshot()
+            result = {
+                    'enabled': self.enabled,
+                    'counters': dict(self.counters),
+                    'latency': latency,
+                    'cpu': dict(self.cpu)
+                    }
+        if self._sampler is not None:
+            result['samples'] = self._sampler.snapshot()
+        return result
+
+    def buckets(self):
+        """ [(kind, name, cumulative counts, sum, count)] for exporting """
+        with self._lock:
+            return [
+                    (kind, name, list(histogram.counts), histogram.total,
+                     histogram.count)
+                    for (kind, name), histogram in self.histograms.items()
+                    ]
+#-------------------------------------------------------------------------------
+    def startSampler(self, interval=0.005):
+        """ Samples the stack of running command functions (opt-in) """
+        if self._sampler is None:
+            self._sampler = Sampler(self.running, interval)
+        self._sampler.start()
+
+    def stopSampler(self):
+        if self._sampler is not None:
+            self._sampler.stop()
+
+
+class Sampler(object):
+    """
+    Every <interval> looks at the threads that run a command function and
+    counts which command (and which line of code) they are in
+    """
+    def __init__(self, running, interval=0.005, depth=10):
+        self.running, self.interval, self.depth = running, interval, depth
+        self.samples = {}
+        self.lines = {}
+        self._thread = None
+        self._running = False
+
+    def start(self):
+        self._running = True
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(name='Sampler', target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+
+    def _run(self):
+        while self._running:
+            time.sleep(self.interval)
+            running = dict(self.running)
+            if not running:
+                continue
+            frames = sys._current_frames()
+            for ident, name in running.items():
+                frame = frames.get(ident)
+                if frame is None:
+                    continue
+                self.samples[name] = self.samples.get(name, 0) + 1
+                code = frame.f_code
+                where = '%s:%d %s' % (
+                        code.co_filename, frame.f_lineno, code.co_name
+                        )
+                lines = self.lines.setdefault(name, {})
+                lines[where] = lines.get(where, 0) + 1
+
+    def snapshot(self):
+        """ {command: {'samples': n, 'secs': ~time, 'top': [[line, n]]}} """
+        result = {}
+        for name, count in list(self.samples.items()):
+            lines = sorted(
+                    self.lines.get(name, {}).items(), key=lambda item: -item[1]
+                    )
+            result[name] = {
+                    'samples': count,
+                    'secs': count * self.interval,
+                    'top': [list(item) for item in lines[:self.depth]]
+                    }
+        return result
+#-------------------------------------------------------------------------------
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"')
+
+
+def prometheus(stats, metrics):
+    """ Renders a stats() dict and the histograms as Prometheus text """
+    out = []
+    for name, value in sorted(stats['counters'].items()):
+        out.append('# TYPE stirbot_%s_total counter' % name)
+        out.append('stirbot_%s_total %s' % (name, value))
+    for section in ('sendq', 'workers'):
+        for name, value in sorted(stats.get(section, {}).items()):
+            if isinstance(value, (int, float)):
+                out.append('stirbot_%s_%s %s' % (section, name, value))
+    for name, secs in sorted(stats['cpu'].items()):
+        out.append('stirbot_command_cpu_seconds_total{name="%s"} %s' % (
+                _label(name), secs))
+    kinds = set()
+    for kind, name, counts, total, count in sorted(metrics.buckets()):
+        metric = 'stirbot_%s_seconds' % kind
+        if kind not in kinds:
+            kinds.add(kind)
+            out.append('# TYPE %s histogram' % metric)
+        name, seen = _label(name), 0
+        for bound, bucket in zip(BUCKETS + ('+Inf',), counts):
+            seen += bucket
+            out.append('%s_bucket{name="%s",le="%s"} %d' % (
+                    metric, name, bound, seen))
+        out.append('%s_sum{name="%s"} %s' % (metric, name, total))
+        out.append('%s_count{name="%s"} %d' % (metric, name, count))
+    return '\n'.join(out) + '\n'
+
+
+class MetricsServer(object):
+    """ Serves <render>() as text on http://<host>:<port>/metrics """
+    def __init__(self, render, host='127.0.0.1', port=9105):
+        # only bots that serve metrics pay for importing http.server
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        self.render = render
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(handler):
+                if handler.path.split('?')[0] not in ('/', '/metrics'):
+                    handler.send_error(404)
+                    return
+                body = self.render().encode('utf-8')
+                handler.send_response(200)
+                handler.send_header(
+                        'Content-Type', 'text/plain; version=0.0.4'
+                        )
+                handler.send_header('Content-Length', str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, format, *args):
+                log.debug('Metrics: ' + format, *args)
+
+        self._httpd = ThreadingHTTPServer((host, port), Handler)
+        self._httpd.daemon_threads = True
+        self.port = self._httpd.server_address[1]
+        self._thread = threading.Thread(
+                name='Metrics', target=self._httpd.serve_forever
+                )
+        self._thread.daemon = True
+        self._thread.start()
+        log.info('Metrics on http://%s:%d/metrics', host, self.port)
+
+    def close(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
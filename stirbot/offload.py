@@ -0,0 +1,206 @@
+""" Runs CPU heavy command functions in worker processes """
+import threading
+
+from .log import log
+
+
+class Match(object):
+    """
+    The picklable parts of a re.Match (re.Match objects can't be sent to
+    another process): group(), groups(), groupdict(), start/end/span()
+    """
+    __slots__ = ('string', '_groups', '_spans', '_names')
+
+    def __init__(self, match):
+        self.string = match.string
+        count = (match.re.groups or 0) + 1
+        self._groups = tuple(match.group(i) for i in range(count))
+        self._spans = tuple(match.span(i) for i in range(count))
+        self._names = dict(match.re.groupindex)
+
+    def _index(self, group):
+        if isinstance(group, str):
+            return self._names[group]
+        return group
+
+    def group(self, *groups):
+        if not groups:
+            return self._groups[0]
+        if len(groups) == 1:
+            return self._groups[self._index(groups[0])]
+        return tuple(self._groups[self._index(group)] for group in groups)
+
+    def __getitem__(self, group):
+        return self.group(group)
+
+    def groups(self, default=None):
+        return tuple(
+                default if group is None else group for group in self._groups[1:]
+                )
+
+    def groupdict(self, default=None):
+        return dict(
+                (name, self._groups[i] if self._groups[i] is not None else default)
+                for name, i in self._names.items()
+                )
+
+    def span(self, group=0):
+        return self._spans[self._index(group)]
+
+    def start(self, group=0):
+        return self.span(group)[0]
+
+    def end(self, group=0):
+        return self.span(group)[1]
+
+    def __repr__(self):
+        return '<stirbot.offload.Match span=%r match=%r>' % (
+                self._spans[0], self._groups[0])
+
+
+class _Job(object):
+    """ One command call in flight """
+    __slots__ = ('name', 'reply', 'pool', 'timer', 'done')
+
+    def __init__(self, name, reply, pool):
+        self.name, self.reply, self.pool = name, reply, pool
+        self.timer = None
+        self.done = False
+
+
+class ProcessOffload(object):
+    """
+    A multiprocessing.Pool for the command functions added with
+    executor='process', so they don't hold the GIL the listener needs
+
+    The function gets (chan, nick, host, Match) and what it returns is
+    handed to the job's reply (the bot sends it as messages). At most
+    <handle.maxjobs> calls of a command are in flight, more are dropped.
+    A call still running after <handle.timeout> seconds is given up on
+    and the pool is killed (and started again on the next call) since
+    the worker running it can't be stopped any other way.
+    The pool is forked from the current process unless <context> names
+    another start method ('forkserver', 'spawn').
+    """
+    def __init__(self, processes=None, context=None):
+        # imported here, most bots never make a process pool
+        import multiprocessing
+        self.processes = processes or multiprocessing.cpu_count()
+        self._context = multiprocessing.get_context(context)
+        self._lock = threading.Lock()
+        self._pool = None
+        self._jobs = set()
+        self._inflight = {}
+        self.completed = self.failed = self.timedout = self.rejected = 0
+
+    def start(self):
+        """ Starts the worker processes (if they are not running) """
+        with self._lock:
+            self._start()
+
+    def _start(self):
+        """ (lock held) """
+        if self._pool is None:
+            self._pool = self._context.Pool(self.processes)
+        return self._pool
+
+    def submit(self, name, handle, args, reply):
+        """ Runs handle.function(*args) in a worker, False if dropped """
+        with self._lock:
+            if self._inflight.get(name, 0) >= handle.maxjobs:
+                self.rejected += 1
+                log.warning(
+                        'Command %s has %d calls in flight, dropped one',
+                        name, handle.maxjobs
+                        )
+                return False
+            pool = self._start()
+            job = _Job(name, reply, pool)
+            self._inflight[name] = self._inflight.get(name, 0) + 1
+            self._jobs.add(job)
+            if handle.timeout:
+                job.timer = threading.Timer(
+                        handle.timeout, self._expire, (job,)
+                        )
+                job.timer.daemon = True
+                job.timer.start()
+        try:
+            pool.apply_async(
+                    handle.function, args,
+                    callback=lambda result: self._finish(job, result),
+                    error_callback=lambda e: self._finish(job, error=e)
+                    )
+        except Exception as e:
+            self._finish(job, error=e)
+        return True
+
+    def _release(self, job):
+        """ Marks a job as done (lock held), False if it already was """
+        if job.done:
+            return False
+        job.done = True
+        self._jobs.discard(job)
+        self._inflight[job.name] -= 1
+        if job.timer is not None:
+            job.timer.cancel()
+        return True
+
+    def _finish(self, job, result=None, error=None):
+        """ A worker is done with a job (pool result thread) """
+        with self._lock:
+            if not self._release(job):
+                return
+            if error is not None:
+                self.failed += 1
+            else:
+                self.completed += 1
+        if error is not None:
+            log.error('Command %s failed in a worker process: %r', job.name, error)
+        elif result is not None:
+            try:
+                job.reply(result)
+            except Exception as e:
+                log.exception(e)
+
+    def _expire(self, job):
+        """ A job ran out of time: kill its pool and everything on it """
+        with self._lock:
+            if job.done:
+                return
+            pool = job.pool
+            lost = [item for item in self._jobs if item.pool is pool]
+            for item in lost:
+                self._release(item)
+            self.timedout += 1
+            self.failed += len(lost) - 1
+            if self._pool is pool:
+                self._pool = None
+        log.warning(
+                'Command %s timed out, restarting the worker processes '
+                '(%d calls lost)', job.name, len(lost)
+                )
+        pool.terminate()
+
+    def stats(self):
+        """ Jobs in flight per command and how the others ended """
+        with self._lock:
+            return {
+                    'processes': self.processes if self._pool else 0,
+                    'inflight': dict(
+                            (name, count)
+                            for name, count in self._inflight.items() if count
+                            ),
+                    'completed': self.completed,
+                    'failed': self.failed,
+                    'timedout': self.timedout,
+                    'rejected': self.rejected
+                    }
+
+    def close(self):
+        """ Kills the worker processes, jobs in flight are lost """
+        with self._lock:
+            pool, self._pool = self._pool, None
+            for job in list(self._jobs):
+                self._release(job)
+        if pool is not None:
+            pool.terminate()
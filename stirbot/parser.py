@@ -0,0 +1,80 @@
+""" Single pass tokenizer for RFC 1459 lines (with IRCv3 message tags) """
+
+# tag value escapes, see https://ircv3.net/specs/extensions/message-tags
+TAGESCAPES = {':': ';', 's': ' ', '\\': '\\', 'r': '\r', 'n': '\n'}
+
+
+class Message(object):
+    """ A tokenized server line """
+    __slots__ = (
+            'raw', 'prefix', 'nick', 'userhost', 'command', 'params', 'tags'
+            )
+
+    def __init__(self, raw, prefix, command, params, tags=None):
+        self.raw, self.prefix = raw, prefix
+        self.command, self.params = command, params
+        self.tags = tags
+        if prefix and '!' in prefix:
+            self.nick, _, self.userhost = prefix.partition('!')
+        else:
+            self.nick, self.userhost = prefix, None
+
+    @property
+    def trailing(self):
+        """ Last parameter (the text after ' :' if there was one) """
+        if self.params:
+            return self.params[-1]
+        return ''
+
+    def __repr__(self):
+        return 'Message(%r)' % self.raw
+
+
+def unescapeTag(value):
+    """ Undoes the message-tags value escaping """
+    if '\\' not in value:
+        return value
+    out, i = [], 0
+    while i < len(value):
+        char = value[i]
+        if char == '\\':
+            i += 1
+            if i < len(value):
+                out.append(TAGESCAPES.get(value[i], value[i]))
+        else:
+            out.append(char)
+        i += 1
+    return ''.join(out)
+
+
+def parseTags(tags):
+    """ 'a=1;b;c=x\\sy' -> {'a': '1', 'b': '', 'c': 'x y'} """
+    parsed = {}
+    for tag in tags.split(';'):
+        if tag:
+            key, _, value = tag.partition('=')
+            parsed[key] = unescapeTag(value)
+    return parsed
+
+
+def parseLine(line):
+    """
+    Splits a line into tags, prefix, command and params in one pass,
+    returns None for empty lines
+    """
+    rest = line
+    tags = prefix = None
+    if rest[:1] == '@':
+        tags, _, rest = rest[1:].partition(' ')
+        tags = parseTags(tags)
+        rest = rest.lstrip(' ')
+    if rest[:1] == ':':
+        prefix, _, rest = rest[1:].partition(' ')
+    rest, sep, trailing = rest.partition(' :')
+    params = rest.split()
+    if not params:
+        return None
+    command = params.pop(0).upper()
+    if sep:
+        params.append(trailing)
+    return Message(line, prefix, command, params, tags)
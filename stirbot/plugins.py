@@ -0,0 +1,150 @@
+""" Loads command modules from a directory and reloads them when they change """
+import importlib.util
+import os
+import sys
+import threading
+
+from .log import log
+
+
+class PluginLoader(object):
+    """
+    Keeps the commands of the modules in <directory> (every *.py not
+    starting with '_') registered on <bot> (an IRCServer or a BotManager)
+
+    A module either has a 'commands' dict of {name: CommandHandle} or a
+    setup(bot) function returning one, and maybe a teardown(bot) called
+    when it is removed or reloaded. On reload the new module is imported
+    first, then the old one's teardown(bot) runs, then the new one's
+    setup(bot), so setup can claim what teardown let go of. scan() (or
+    the thread started by start(), every <interval> seconds) reloads the
+    modules whose file changed and swaps all of their commands in with
+    one bot.updateCommands() call. A module that fails to import keeps
+    its old commands (and is not torn down) until it is fixed.
+    """
+    def __init__(self, bot, directory, interval=2.0):
+        self.bot, self.directory, self.interval = bot, directory, interval
+        # path -> (mtime, size) when last loaded
+        self._seen = {}
+        # path -> (module, [command names])
+        self._loaded = {}
+        self._stop = threading.Event()
+        self._thread = None
+        self.loads = self.failures = 0
+
+    def _files(self):
+        """ {path: (mtime, size)} of the plugin modules """
+        found = {}
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.py') and not entry.name.startswith('_') \
+                    and entry.is_file():
+                stat = entry.stat()
+                found[entry.path] = (stat.st_mtime_ns, stat.st_size)
+        return found
+
+    def _import(self, path):
+        """ Executes the module at <path> (a fresh module every time) """
+        name = 'stirbot_plugin_%s' % os.path.basename(path)[:-3]
+        spec = importlib.util.spec_from_file_location(name, path)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        try:
+            spec.loader.exec_module(module)
+        except BaseException:
+            # keep the last module that loaded
+            previous = self._loaded.get(path)
+            if previous is not None:
+                sys.modules[name] = previous[0]
+            else:
+                del sys.modules[name]
+            raise
+        return module
+
+    def _commands(self, module):
+        """ The {name: CommandHandle} a module provides """
+        setup = getattr(module, 'setup', None)
+        if setup is not None:
+            return dict(setup(self.bot) or {})
+        return dict(getattr(module, 'commands', {}))
+
+    def _teardown(self, path):
+        """ Lets a module that is going away clean up """
+        module = self._loaded[path][0]
+        teardown = getattr(module, 'teardown', None)
+        if teardown is not None:
+            try:
+                teardown(self.bot)
+            except Exception as e:
+                log.exception(e)
+
+    def scan(self):
+        """
+        Loads new and changed modules, drops the commands of removed
+        ones, returns the names of the commands that changed
+        """
+        files = self._files()
+        add, remove = {}, []
+        for path in list(self._loaded):
+            if path not in files:
+                self._teardown(path)
+                remove.extend(self._loaded.pop(path)[1])
+                del self._seen[path]
+                log.info('Plugin %s removed', path)
+        for path, seen in sorted(files.items()):
+            if self._seen.get(path) == seen:
+                continue
+            self._seen[path] = seen
+            try:
+                module = self._import(path)
+            except Exception as e:
+                self.failures += 1
+                log.error('Plugin %s failed to load: %r', path, e)
+                continue
+            old = None
+            if path in self._loaded:
+                self._teardown(path)
+                old = self._loaded[path][1]
+            try:
+                commands = self._commands(module)
+            except Exception as e:
+                # torn down already, its old commands stay registered
+                self.failures += 1
+                log.error('Plugin %s failed to set up: %r', path, e)
+                if old is not None:
+                    self._loaded[path] = (module, old)
+                continue
+            if old is not None:
+                remove.extend(name for name in old if name not in commands)
+            self._loaded[path] = (module, list(commands))
+            add.update(commands)
+            self.loads += 1
+            log.info('Plugin %s loaded: %s', path, ', '.join(commands))
+        if add or remove:
+            self.bot.updateCommands(add, remove)
+        return list(add) + remove
+
+    def start(self):
+        """ Scans now and then every <interval> seconds in a thread """
+        self.scan()
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(
+                    target=self._watch, name='stirbot-plugins', daemon=True
+                    )
+            self._thread.start()
+        return self
+
+    def _watch(self):
+        """ The polling thread """
+        while not self._stop.wait(self.interval):
+            try:
+                self.scan()
+            except Exception as e:
+                log.exception(e)
+
+    def stop(self):
+        """ Stops watching (the commands stay registered) """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
@@ -0,0 +1,204 @@
+""" Flood controlled outbound queue """
+import time
+import threading
+from collections import deque
+
+from .log import log
+
+# queues are drained in this order
+PONG, CONTROL, MESSAGE, LAST = range(4)
+PRIORITIES = {
+        'PONG': PONG, 'PRIVMSG': MESSAGE, 'NOTICE': MESSAGE, 'QUIT': LAST,
+        # registration (and SASL) is not held up by flood control
+        'CAP': PONG, 'AUTHENTICATE': PONG, 'PASS': PONG, 'USER': PONG
+        }
+# 512 bytes with \r\n, minus the ':nick!user@host ' the server puts in front
+MAXLINE = 510
+PREFIXLEN = 1 + 30 + 1 + 10 + 1 + 63 + 1
+
+
+def splitLine(line, limit=MAXLINE - PREFIXLEN):
+    """
+    Splits a 'PRIVMSG/NOTICE <target> :<text>' line into lines of at most
+    <limit> utf-8 bytes, on whitespace where possible and never inside
+    a character, a CTCP (\x01ACTION ...\x01) is split into CTCPs (other
+    lines are returned as they are)
+    """
+    if len(line) * 4 <= limit or len(line.encode('utf-8')) <= limit:
+        return [line]
+    head, sep, text = line.partition(' :')
+    if not sep:
+        return [line]
+    head, tail = head + sep, ''
+    if len(text) > 1 and text[0] == '\x01' and text[-1] == '\x01':
+        command, space, text = text[1:-1].partition(' ')
+        head, tail = head + '\x01' + command + space, '\x01'
+    room = limit - len((head + tail).encode('utf-8'))
+    if room < 4 or not text:
+        return [line]
+    raw, lines = text.encode('utf-8'), []
+    while len(raw) > room:
+        cut = room
+        while raw[cut] & 0xC0 == 0x80:
+            cut -= 1
+        space = raw.rfind(b' ', 0, cut + 1)
+        if space > room // 2:
+            cut = space
+        lines.append(head + raw[:cut].decode('utf-8') + tail)
+        raw = raw[cut:].lstrip(b' ')
+    if raw:
+        lines.append(head + raw.decode('utf-8') + tail)
+    return lines
+
+
+class SendQueue(object):
+    """
+    Priority queue of outbound lines with token bucket flood control
+
+    PONGs and registration lines (CAP, AUTHENTICATE, PASS, USER) go out
+    right away, then control lines (JOIN, MODE...), then
+    PRIVMSG/NOTICE and QUIT last so it never overtakes anything. Up to
+    <burst> lines can be sent at once, after that <rate> lines a second
+    (rate=None turns flood control off). Everything that may be sent is
+    joined into one write() call.
+
+    start() drains the queue with a writer thread, or take()/flush() can
+    be driven from somewhere else (an event loop), <notify> is called
+    after every put().
+    """
+    def __init__(self, write, rate=0.5, burst=5, onError=None, notify=None):
+        self.write, self.onError, self.notify = write, onError, notify
+        self.rate, self.burst = rate, burst
+        self._queues = [deque() for _ in range(LAST + 1)]
+        self._lock = threading.Condition()
+        self._tokens, self._stamp = float(burst), time.monotonic()
+        self._thread = None
+        self._running = False
+        self.sent = self.flushes = 0
+        self._waitTotal = self._waitMax = 0.0
+
+    def __len__(self):
+        return sum(len(queue) for queue in self._queues)
+
+    def put(self, line):
+        """ Queue a line (without \\r\\n), long messages are split """
+        priority = PRIORITIES.get(line.split(' ', 1)[0].upper(), CONTROL)
+        if priority == MESSAGE:
+            lines = splitLine(line)
+        else:
+            lines = [line]
+        now = time.monotonic()
+        with self._lock:
+            self._queues[priority].extend((now, item) for item in lines)
+            self._lock.notify()
+        if self.notify is not None:
+            self.notify()
+
+    def clear(self):
+        """ Drop everything queued (the connection is gone) """
+        with self._lock:
+            for queue in self._queues:
+                queue.clear()
+            self._tokens, self._stamp = float(self.burst), time.monotonic()
+
+    def refill(self):
+        """ Gives the whole burst back, keeping what is queued """
+        with self._lock:
+            self._tokens, self._stamp = float(self.burst), time.monotonic()
+            self._lock.notify()
+        if self.notify is not None:
+            self.notify()
+
+    def stats(self):
+        """ Queue depth and wait time snapshot """
+        with self._lock:
+            depths = [len(queue) for queue in self._queues]
+        names = ('pong', 'control', 'message', 'last')
+        return {
+                'depth': sum(depths),
+                'depths': dict(zip(names, depths)),
+                'sent': self.sent,
+                'flushes': self.flushes,
+                'waitAvg': self._waitTotal / self.sent if self.sent else 0.0,
+                'waitMax': self._waitMax,
+                'tokens': self._tokens
+                }
+#-------------------------------------------------------------------------------
+    def _take(self):
+        """
+        Pops what may be sent now (lock held), returns (batch, delay) where
+        delay is how long until more can be sent (None if nothing waits)
+        """
+        queues = self._queues
+        batch = list(queues[PONG])
+        queues[PONG].clear()
+        if not self.rate:
+            for queue in queues[CONTROL:]:
+                batch.extend(queue)
+                queue.clear()
+            return batch, None
+        now = time.monotonic()
+        self._tokens = min(
+                self.burst, self._tokens + (now - self._stamp) * self.rate
+                )
+        self._stamp = now
+        for queue in queues[CONTROL:]:
+            while queue and self._tokens >= 1:
+                batch.append(queue.popleft())
+                self._tokens -= 1
+        if any(queues):
+            return batch, (1 - self._tokens) / self.rate
+        return batch, None
+
+    def take(self):
+        """ Pops what may be sent now, returns (batch, delay) """
+        with self._lock:
+            return self._take()
+
+    def flush(self, batch):
+        """ Writes a batch from take() with one write() call """
+        if not batch:
+            return
+        now = time.monotonic()
+        data = ''.join(['%s\r\n' % line for _, line in batch]).encode('utf-8')
+        try:
+            self.write(data)
+        except Exception as e:
+            if self.onError is None:
+                raise
+            self.onError(e)
+            return
+        for stamp, _ in batch:
+            wait = now - stamp
+            self._waitTotal += wait
+            if wait > self._waitMax:
+                self._waitMax = wait
+        self.sent += len(batch)
+        self.flushes += 1
+#-------------------------------------------------------------------------------
+    def start(self):
+        """ Start the writer thread (if it is not running) """
+        self._running = True
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(name='Writer', target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """ Stop the writer thread """
+        with self._lock:
+            self._running = False
+            self._lock.notify()
+
+    def _run(self):
+        """ Writer thread: flush whenever the bucket allows it """
+        log.debug('Writer started')
+        while self._running:
+            with self._lock:
+                batch, delay = self._take()
+                if not batch:
+                    self._lock.wait(delay)
+                    continue
+            self.flush(batch)
+        log.debug('Writer stopped')
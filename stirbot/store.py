@@ -0,0 +1,263 @@
+""" Optional SQLite store for channel traffic and channel state """
+import atexit
+import queue
+import sqlite3
+import threading
+import time
+
+from .log import log
+
+SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS events ('
+        ' time REAL NOT NULL, network TEXT NOT NULL, kind TEXT NOT NULL,'
+        ' channel TEXT, nick TEXT COLLATE NOCASE, host TEXT, text TEXT)',
+        'CREATE INDEX IF NOT EXISTS events_channel'
+        ' ON events (channel, time)',
+        'CREATE INDEX IF NOT EXISTS events_nick ON events (nick, time)',
+        'CREATE TABLE IF NOT EXISTS channels ('
+        ' network TEXT NOT NULL, name TEXT NOT NULL, topic TEXT,'
+        ' updated REAL, PRIMARY KEY (network, name))',
+        'CREATE TABLE IF NOT EXISTS members ('
+        ' network TEXT NOT NULL, channel TEXT NOT NULL, nick TEXT NOT NULL,'
+        ' flags INTEGER, host TEXT, PRIMARY KEY (network, channel, nick))'
+        )
+
+INSERTEVENT = (
+        'INSERT INTO events (time, network, kind, channel, nick, host, text)'
+        ' VALUES (?, ?, ?, ?, ?, ?, ?)'
+        )
+
+# queue sentinel
+_STOP = object()
+
+
+class Store(object):
+    """
+    Keeps what the bot sees (messages, joins, parts, quits, kicks, nick
+    and topic changes) and the last known state of its channels in an
+    SQLite database in WAL mode
+
+    The reader only queues rows, a background thread writes them in
+    batches of up to <batch> rows, at most <interval> seconds after the
+    first one was queued. If more than <queuesize> rows are waiting new
+    ones are dropped instead of blocking the reader. The queries (seen,
+    lastMessage, history, activity, channel) read through their own
+    connection per thread so they can run in command functions while
+    the writer is busy, rows still queued are not seen until written.
+    """
+    def __init__(self, path, batch=500, interval=1.0, queuesize=100000):
+        self.path, self.batch, self.interval = path, batch, interval
+        self._queue = queue.Queue(queuesize)
+        self._local = threading.local()
+        self.written = self.dropped = self.batches = 0
+        db = sqlite3.connect(path)
+        db.execute('PRAGMA journal_mode=WAL')
+        for statement in SCHEMA:
+            db.execute(statement)
+        db.commit()
+        db.close()
+        self._writer = threading.Thread(
+                target=self._run, name='stirbot-store', daemon=True
+                )
+        self._writer.start()
+        atexit.register(self.close)
+
+#-------------------------------------------------------------------------------
+    def _put(self, item):
+        """ Queues <item> for the writer, never blocks """
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+
+    def add(self, network, kind, channel, nick, host=None, text=None):
+        """ Records an event (kind: privmsg, notice, join, part...) """
+        self._put(('event', (
+                time.time(), network, kind, channel, nick, host, text
+                )))
+
+    def saveChannel(self, network, channel, users):
+        """
+        Records the topic and users of a channels.Channel, <users> is the
+        Membership.users dict (for the hosts)
+        """
+        members = []
+        for nick, flags in channel.members.items():
+            user = users.get(nick)
+            members.append((nick, flags, user.host if user else None))
+        self._put(('channel', (network, channel.name, channel.topic, members)))
+
+    def flush(self, timeout=None):
+        """ Waits until everything queued so far is written """
+        done = threading.Event()
+        self._queue.put(('flush', done))
+        return done.wait(timeout)
+
+    def close(self):
+        """ Writes what is queued and stops the writer """
+        if self._writer.is_alive():
+            self._queue.put(_STOP)
+            self._writer.join()
+
+    def stats(self):
+        return {
+                'queued': self._queue.qsize(),
+                'written': self.written,
+                'dropped': self.dropped,
+                'batches': self.batches
+                }
+
+#-------------------------------------------------------------------------------
+    def _run(self):
+        """ The writer thread """
+        db = sqlite3.connect(self.path)
+        db.execute('PRAGMA synchronous=NORMAL')
+        running = True
+        while running:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.batch and batch[-1] is not _STOP \
+                    and batch[-1][0] != 'flush':
+                try:
+                    batch.append(self._queue.get(
+                            timeout=max(0, deadline - time.monotonic())
+                            ))
+                except queue.Empty:
+                    break
+            if batch[-1] is _STOP:
+                batch.pop()
+                running = False
+            try:
+                self._write(db, batch)
+            except sqlite3.Error as e:
+                log.error('Store: lost a batch of %d rows: %r', len(batch), e)
+        db.close()
+
+    def _write(self, db, batch):
+        """ Writes one batch in one transaction """
+        events, waiting = [], []
+        with db:
+            for kind, item in batch:
+                if kind == 'event':
+                    events.append(item)
+                    continue
+                if events:
+                    db.executemany(INSERTEVENT, events)
+                    self.written += len(events)
+                    events = []
+                if kind == 'channel':
+                    self._writeChannel(db, *item)
+                elif kind == 'flush':
+                    waiting.append(item)
+            if events:
+                db.executemany(INSERTEVENT, events)
+                self.written += len(events)
+        self.batches += 1
+        for done in waiting:
+            done.set()
+
+    def _writeChannel(self, db, network, name, topic, members):
+        """ Replaces the stored state of a channel """
+        db.execute(
+                'INSERT OR REPLACE INTO channels VALUES (?, ?, ?, ?)',
+                (network, name, topic, time.time())
+                )
+        db.execute(
+                'DELETE FROM members WHERE network = ? AND channel = ?',
+                (network, name)
+                )
+        db.executemany(
+                'INSERT INTO members VALUES (?, ?, ?, ?, ?)',
+                [(network, name, nick, flags, host)
+                        for nick, flags, host in members]
+                )
+
+#-------------------------------------------------------------------------------
+    def _reader(self):
+        """ This thread's read connection """
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = self._local.db = sqlite3.connect(self.path)
+            db.row_factory = sqlite3.Row
+        return db
+
+    def _events(self, where, args, limit=1):
+        """ Newest events matching <where> as dicts """
+        rows = self._reader().execute(
+                'SELECT * FROM events WHERE %s ORDER BY time DESC LIMIT ?'
+                % ' AND '.join(where), args + [limit]
+                ).fetchall()
+        return [dict(row) for row in rows]
+
+    def seen(self, nick, network=None):
+        """ The last thing <nick> did, None if never seen """
+        where, args = ['nick = ?'], [nick]
+        if network is not None:
+            where.append('network = ?')
+            args.append(network)
+        found = self._events(where, args)
+        return found[0] if found else None
+
+    def lastMessage(self, nick, channel=None, network=None):
+        """ The last thing <nick> said (in <channel>), None if nothing """
+        where, args = ['nick = ?', "kind = 'privmsg'"], [nick]
+        if channel is not None:
+            where.append('channel = ?')
+            args.append(channel)
+        if network is not None:
+            where.append('network = ?')
+            args.append(network)
+        found = self._events(where, args)
+        return found[0] if found else None
+
+    def history(self, channel, limit=50, before=None, network=None):
+        """ The last <limit> events in <channel> (before <before>) """
+        where, args = ['channel = ?'], [channel]
+        if before is not None:
+            where.append('time < ?')
+            args.append(before)
+        if network is not None:
+            where.append('network = ?')
+            args.append(network)
+        return self._events(where, args, limit)
+
+    def activity(self, channel, since=None, limit=10, network=None):
+        """ [(nick, messages)] of the most active nicks in <channel> """
+        where, args = ['channel = ?', "kind = 'privmsg'"], [channel]
+        if since is not None:
+            where.append('time >= ?')
+            args.append(since)
+        if network is not None:
+            where.append('network = ?')
+            args.append(network)
+        rows = self._reader().execute(
+                'SELECT nick, COUNT(*) FROM events WHERE %s GROUP BY nick'
+                ' ORDER BY COUNT(*) DESC LIMIT ?' % ' AND '.join(where),
+                args + [limit]
+                ).fetchall()
+        return [tuple(row) for row in rows]
+
+    def channel(self, name, network):
+        """
+        The last saved state of a channel: {'topic', 'updated', 'members':
+        {nick: (flags, host)}}, None if it was never saved
+        """
+        db = self._reader()
+        row = db.execute(
+                'SELECT topic, updated FROM channels'
+                ' WHERE network = ? AND name = ?', (network, name)
+                ).fetchone()
+        if row is None:
+            return None
+        members = db.execute(
+                'SELECT nick, flags, host FROM members'
+                ' WHERE network = ? AND channel = ?', (network, name)
+                ).fetchall()
+        return {
+                'topic': row['topic'],
+                'updated': row['updated'],
+                'members': dict(
+                        (member['nick'], (member['flags'], member['host']))
+                        for member in members
+                        )
+                }
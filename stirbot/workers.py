@@ -0,0 +1,165 @@
+""" Bounded worker pool with per-key ordering """
+import threading
+from collections import deque
+
+from .log import log
+
+OVERFLOW = ('drop', 'oldest', 'block')
+
+
+class SerialPool(object):
+    """
+    Runs jobs on up to <threads> worker threads, jobs submitted with the
+    same key (a channel) run one at a time in the order they came in,
+    different keys run in parallel
+
+    At most <maxqueue> jobs wait at once, when full <overflow> decides:
+        'drop': the new job is dropped
+        'oldest': the oldest job waiting under the same key is dropped
+        'block': submit() waits for room (this blocks the caller!)
+    Threads are only started when there is work for them.
+    """
+    def __init__(
+                self, threads=4, maxqueue=1000, overflow='drop', name='Worker'
+                ):
+        if overflow not in OVERFLOW:
+            raise ValueError('overflow must be one of %s' % str(OVERFLOW))
+        self.threads, self.maxqueue = int(threads), maxqueue
+        self.overflow, self.name = overflow, name
+        self._lock = threading.Condition()
+        self._space = threading.Condition(self._lock)
+        self._jobs = {}
+        # keys that have jobs waiting and nobody working on them
+        self._ready = deque()
+        self._busy = set()
+        self._workers = []
+        self._idle = 0
+        self._queued = 0
+        self._closed = False
+        self.completed = self.dropped = self.failed = 0
+
+    def submit(self, key, func, *args):
+        """ Queue func(*args) behind the other jobs for <key> """
+        with self._lock:
+            if self._closed:
+                return False
+            replaced = False
+            while self._queued >= self.maxqueue:
+                if self.overflow == 'block':
+                    self._space.wait()
+                    continue
+                if self.overflow == 'oldest' and self._jobs.get(key):
+                    self._jobs[key].popleft()
+                    self._queued -= 1
+                    self.dropped += 1
+                    replaced = True
+                    break
+                self.dropped += 1
+                if self.dropped % 1000 == 1:
+                    log.warning(
+                            'Worker queue full, %d jobs dropped so far',
+                            self.dropped
+                            )
+                return False
+            jobs = self._jobs.get(key)
+            if jobs is None:
+                jobs = self._jobs[key] = deque()
+            jobs.append((func, args))
+            self._queued += 1
+            if not replaced and key not in self._busy and len(jobs) == 1:
+                self._ready.append(key)
+            if self._idle:
+                self._lock.notify()
+            elif len(self._workers) < self.threads:
+                self._spawn()
+        return True
+
+    def _spawn(self):
+        """ Start one more worker thread (lock held) """
+        worker = threading.Thread(
+                name='%s-%d' % (self.name, len(self._workers)), target=self._run
+                )
+        worker.daemon = True
+        self._workers.append(worker)
+        worker.start()
+
+    def _run(self):
+        """ Worker thread: run one job of a ready key at a time """
+        while True:
+            with self._lock:
+                while not self._ready and not self._closed:
+                    self._idle += 1
+                    self._lock.wait()
+                    self._idle -= 1
+                if not self._ready:
+                    self._workers.remove(threading.current_thread())
+                    return
+                key = self._ready.popleft()
+                jobs = self._jobs[key]
+                func, args = jobs.popleft()
+                self._queued -= 1
+                self._busy.add(key)
+                self._space.notify()
+            try:
+                func(*args)
+            except Exception as e:
+                self.failed += 1
+                log.exception(e)
+            with self._lock:
+                self.completed += 1
+                self._busy.discard(key)
+                if jobs:
+                    self._ready.append(key)
+                elif self._jobs.get(key) is jobs:
+                    del self._jobs[key]
+
+    def __len__(self):
+        return self._queued
+
+    def stats(self):
+        """ Snapshot of the queue and thread counts """
+        with self._lock:
+            return {
+                    'queued': self._queued,
+                    'running': len(self._busy),
+                    'keys': len(self._jobs),
+                    'threads': len(self._workers),
+                    'completed': self.completed,
+                    'dropped': self.dropped,
+                    'failed': self.failed
+                    }
+
+    def clear(self, match=None):
+        """
+        Drop every job that has not started yet (only those whose key
+        <match>(key) is true for)
+        """
+        with self._lock:
+            for key in list(self._jobs):
+                if match is not None and not match(key):
+                    continue
+                jobs = self._jobs[key]
+                self.dropped += len(jobs)
+                self._queued -= len(jobs)
+                if key not in self._busy:
+                    del self._jobs[key]
+                else:
+                    jobs.clear()
+            if match is None:
+                self._ready.clear()
+            else:
+                self._ready = deque(
+                        key for key in self._ready if key in self._jobs
+                        )
+            self._space.notify_all()
+
+    def close(self):
+        """ Let the workers finish what is queued and exit """
+        with self._lock:
+            self._closed = True
+            self._lock.notify_all()
+
+    def join(self, timeout=None):
+        """ Wait for the workers to exit (after close()) """
+        for worker in list(self._workers):
+            worker.join(timeout)